@@ -1,10 +1,34 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import numpy as np
 import pandas as pd
 from timeit import default_timer as timer
 import itertools
+import multiprocessing
+import pickle
+import heapq
+import os
+import logging
+import json
+import hashlib
+import base64
+import binascii
+import io
+import time
+import threading
+import queue
+import uuid
+import inspect
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial, wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+from math import sqrt, floor, ceil
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
 from scipy.optimize import minimize
+from scipy.optimize import linprog
+from scipy.optimize import milp, LinearConstraint, Bounds as VariableBounds
 from scipy.optimize import linear_sum_assignment
 
 app = Flask(__name__)
@@ -12,134 +36,367 @@ CORS(app)  # Enable CORS for cross-origin requests
 
 MAX_VALUATION = 10
 epsilon = 0.0025 / MAX_VALUATION
+#Positions within this fraction of a cell of a grid point are taken to be on it, as
+#x / epsilon is not exact in floating point.
+GRID_TOLERANCE = 1e-9
+
+#Number of processes used to solve the jobs sent to the batch endpoint.
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 1))
+_batch_executor = None
 
-#Preprocessing Below
 
-def normalization(prefs):
+def batch_executor():
     '''
-    Ensures that each agents' valuation functions have max value at most 1 at any point.
+    Returns the process pool for solving batch jobs, creating it on first use.
     '''
-    #Need to change.
-    for agents in prefs:
-        for segments in agents:
-            segments['startValue'] /= MAX_VALUATION
-            segments['endValue'] /= MAX_VALUATION
-    return prefs#, normalizationConstants
-        
+    global _batch_executor
+    if _batch_executor is None:
+        _batch_executor = ProcessPoolExecutor(max_workers = BATCH_WORKERS, 
+                                              initializer = disable_result_cache)
+    return _batch_executor
+
+#Number of results kept by the result cache and the seconds each is kept for.
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 1024))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 3600))
+#Algorithm options that change the result, so are part of the result cache key.
+RESULT_OPTIONS = ('method', 'search', 'early_exit')
+_result_cache = None
 
-def change_bounds(prefs, cakeSize):
+
+def result_cache():
     '''
-    Ensures that the valuation functions are on interval [0,1]
+    Returns the cache of algorithm results, creating it on first use.
     '''
-    for agents in prefs:
-        for segments in agents:
-            app.logger.debug("hello")
-            app.logger.debug(type(segments))
-            app.logger.debug(segments)
-            segments['start'] /= cakeSize
-            segments['end'] /= cakeSize
-    return prefs
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+    return _result_cache
 
 
-def one_lipschitz(prefs, cakeSize):
+def disable_result_cache():
     '''
-    Ensures that each agents' valuation functions are 1-Lipschitz continuous.
+    Gives a pool worker an empty result cache. The results of batch and queued jobs are
+    looked up and stored by the parent process, where they are shared between requests.
     '''
-    prefs = change_bounds(prefs, cakeSize)
-    prefs = normalization(prefs)
-    return prefs
-#Preprocessing above
+    global _result_cache
+    _result_cache = ResultCache(0, 0)
 
-#ValueQuery Stuff below
+#Number of processes used to solve the long and the short jobs submitted to the jobs
+#endpoint, and the number of jobs each lane holds waiting before refusing more.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+SHORT_JOB_WORKERS = int(os.environ.get('SHORT_JOB_WORKERS', 1))
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', 100))
+_job_queue = None
 
-def interpolate(segment, x_coordinate):
+
+def job_queue():
     '''
-    Uses the linear interpolation formula to find the associated y-coordinate for a 
-    given x-coordinate on a line between two points with known x and y coordinates.
+    Returns the queue for submitted jobs, creating it on first use.
     '''
-    if segment['startValue'] == segment['endValue']:
-        y_coordinate = segment['startValue']
-        return y_coordinate
-    if segment['startValue'] != segment['endValue']:
-        y_coordinate = ((segment['startValue'] * (segment['end'] - x_coordinate) +
-                         segment['endValue'] * (x_coordinate - segment['start'])) / 
-                        (segment['end'] - segment['start']))                
-        return y_coordinate
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = JobQueue({'long': JOB_WORKERS, 'short': SHORT_JOB_WORKERS}, 
+                              JOB_QUEUE_LIMIT)
+    return _job_queue
+
+#Number of solve sessions kept and the seconds an unused session is kept for.
+SESSION_LIMIT = int(os.environ.get('SESSION_LIMIT', 256))
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 1800))
+_solve_sessions = None
 
 
-def find_partial_value_right_side(segment, partial_segment_end):
+def solve_sessions():
     '''
-    Finds the partial value of a segment with endpoint between the 
-    segment's defined start and end.
+    Returns the store of solve sessions, creating it on first use.
     '''
-    segment_width = partial_segment_end - segment['start']
-    partial_segment_start_value = segment['startValue']
-    partial_segment_end_value = interpolate(segment, partial_segment_end)
-    return area_under_curve(segment, partial_segment_start_value,
-                            partial_segment_end_value, segment_width)
+    global _solve_sessions
+    if _solve_sessions is None:
+        _solve_sessions = SessionStore(SESSION_LIMIT, SESSION_TTL)
+    return _solve_sessions
 
-    
-def find_partial_value_left_side(segment, partial_segment_start):
+
+#Number of processes that check the Hollender-Rubinstein invariant cases of each alpha
+#step in parallel, and the number of solves that can use them at once. The cases are 
+#checked sequentially when INVARIANT_WORKERS is 0, the default.
+INVARIANT_WORKERS = int(os.environ.get('INVARIANT_WORKERS', 0))
+INVARIANT_SOLVES = int(os.environ.get('INVARIANT_SOLVES', 8))
+_invariant_pool = None
+
+
+def invariant_pool():
     '''
-    Finds the partial value of a segment with startpoint between the 
-    segment's defined start and end.
+    Returns the worker pool for checking invariant cases in parallel, creating it on 
+    first use, or None if INVARIANT_WORKERS is 0.
     '''
-    segment_width = segment['end'] - partial_segment_start
-    partial_segment_start_value = interpolate(segment, partial_segment_start)
-    partial_segment_end_value = segment['endValue']
-    return area_under_curve(segment, partial_segment_start_value,
-                            partial_segment_end_value, segment_width)
+    global _invariant_pool
+    if INVARIANT_WORKERS == 0:
+        return None
+    if _invariant_pool is None:
+        _invariant_pool = InvariantPool(INVARIANT_WORKERS, INVARIANT_SOLVES)
+    return _invariant_pool
 
-    
-def find_partial_value_two_sided(segment, partial_segment_start, partial_segment_end):
+#Number of solves whose compiled preferences each invariant worker keeps.
+INVARIANT_WORKER_PREFERENCES = 16
+#The rank of the first case found to hold in each solve using the invariant workers, 
+#shared with them, and the preferences each worker has compiled by solve.
+_invariant_stop_ranks = None
+_invariant_preferences = OrderedDict()
+
+
+def init_invariant_worker(stop_ranks):
     '''
-    Finds the partial value of a segment with startpoint and endpoint
-    between the segment's defined start and end.
+    Gives an invariant worker the ranks it stops checking cases after.
     '''
-    segment_width = partial_segment_end - partial_segment_start
-    partial_segment_start_value = interpolate(segment, partial_segment_start)
-    partial_segment_end_value = interpolate(segment, partial_segment_end)
-    return area_under_curve(segment, partial_segment_start_value,
-                            partial_segment_end_value, segment_width)
+    global _invariant_stop_ranks
+    _invariant_stop_ranks = stop_ranks
 
-    
-def area_under_curve(segment, start_value, end_value, width):
+
+#Instrumentation Below
+
+_phase_timings = ContextVar('phase_timings', default = None)
+_query_counts = ContextVar('query_counts', default = None)
+_current_phase = ContextVar('current_phase', default = None)
+
+
+@contextmanager
+def record_timings():
     '''
-    Finds the area under of the piecewise-linear segment.
+    Records the wall and CPU time of the phases run inside the block in the current 
+    context. Yields the PhaseTimings the times are added to.
     '''
-    if segment['startValue'] == segment['endValue']:
-        value = start_value * width
-        return value
-    if segment['startValue'] != segment['endValue']:
-        value = 0.5 * (start_value + end_value) * width
-        return value
+    timings = PhaseTimings()
+    token = _phase_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        timings.finish()
+        _phase_timings.reset(token)
 
 
-def find_full_value(segment):
+@contextmanager
+def record_query_counts():
     '''
-    Finds the area under of the piecewise-linear segment.
+    Counts the queries made inside the block in the current context. Yields the 
+    QueryCounts the queries are added to.
     '''
-    segment_width = segment['end'] - segment['start']
-    if segment['startValue'] == segment['endValue']:
-        value = segment['startValue'] * segment_width
-        return value
-    if segment['startValue'] != segment['endValue']:
-        value = 0.5 * (segment['startValue'] + segment['endValue']) * segment_width
-        return value
-    
+    counts = QueryCounts()
+    token = _query_counts.set(counts)
+    try:
+        yield counts
+    finally:
+        _query_counts.reset(token)
+
+
+@contextmanager
+def timed_phase(name):
+    '''
+    Marks the block as a phase, nested under the phase it runs inside, when timings or
+    query counts are being recorded. Does nothing otherwise.
+    '''
+    timings = _phase_timings.get()
+    if timings is None and _query_counts.get() is None:
+        yield
+        return
+    parent = _current_phase.get()
+    path = name if parent is None else f'{parent}/{name}'
+    token = _current_phase.set(path)
+    if timings is not None:
+        timings.start(path)
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings.stop()
+        _current_phase.reset(token)
+
+
+def timed(name):
+    '''
+    Decorator that marks every call of a function as a phase.
+    '''
+    def decorator(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            if _phase_timings.get() is None and _query_counts.get() is None:
+                return function(*args, **kwargs)
+            with timed_phase(name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorator
+
+
+def counted(query_type):
+    '''
+    Decorator that counts the calls of a query function, by the agent in its first 
+    argument and the current phase, when query counts are being recorded. Queries made
+    inside another counted query are part of it and are not counted.
+    '''
+    def decorator(function):
+        @wraps(function)
+        def counted_function(agent, *args, **kwargs):
+            counts = _query_counts.get()
+            if counts is None or counts.depth > 0:
+                return function(agent, *args, **kwargs)
+            counts.add(query_type, agent, _current_phase.get())
+            counts.depth += 1
+            try:
+                return function(agent, *args, **kwargs)
+            finally:
+                counts.depth -= 1
+        return counted_function
+    return decorator
+
+
+def current_query_counts():
+    '''
+    Returns the number of queries made so far by type, or None if queries are not being
+    counted.
+    '''
+    counts = _query_counts.get()
+    if counts is None:
+        return None
+    return counts.as_dict()['by_type']
+
+
+def count_queries(query_type, agents):
+    '''
+    Counts one query per entry of an array of agents, for queries made in a batch.
+    '''
+    counts = _query_counts.get()
+    if counts is None or counts.depth > 0:
+        return
+    agent_numbers, query_numbers = np.unique(agents, return_counts = True)
+    for agent, number in zip(agent_numbers.tolist(), query_numbers.tolist()):
+        counts.add(query_type, agent, _current_phase.get(), number)
+#Instrumentation above
+
+#Preprocessing Below
+
+@timed('preprocess')
+def preprocess(raw_prefs, cake_size, hungry_epsilon = None):
+    '''
+    Returns the preferences on the interval [0,1] with values at most 1 at any point, so
+    that each agents' valuation functions are 1-Lipschitz continuous. If hungry_epsilon 
+    is given, the valuation functions of agents with zero valued segments are also made
+    hungry. Done in one vectorised pass per agent; the input is not modified and the 
+    returned preferences are read-only.
+    '''
+    if isinstance(raw_prefs, ColumnarPreferences):
+        prefs = raw_prefs
+    else:
+        prefs = ColumnarPreferences.from_segments(raw_prefs)
+    prefs = prefs.scaled(cake_size, MAX_VALUATION)
+    if hungry_epsilon is not None:
+        prefs = prefs.hungry(hungry_epsilon)
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug('Preprocessed %d agents with %s segments for cake size %s', 
+                         len(prefs), [len(columns[0]) for columns in prefs.agents], 
+                         cake_size)
+    return prefs
+
+
+def compile_preferences(prefs, session = None):
+    '''
+    Compiles each agents' list of segments into a prefix-sum index so that eval
+    queries no longer have to walk the segments. Already compiled preferences are
+    returned unchanged. If a solve session is given, the compiled valuations and 
+    query caches of agents whose preferences have not changed since its last solve 
+    are reused.
+    '''
+    if isinstance(prefs, CompiledPreferences):
+        return prefs
+    if session is not None:
+        if not isinstance(prefs, ColumnarPreferences):
+            prefs = ColumnarPreferences.from_segments(prefs)
+        return session.compile(prefs)
+    if isinstance(prefs, ColumnarPreferences):
+        return prefs.compile()
+    return CompiledPreferences([AgentValuation.from_segments(segments) 
+                                for segments in prefs])
+
+
+def read_npy(buffer):
+    '''
+    Reads a one dimensional .npy file held in a bytes buffer without copying its data.
+    '''
+    stream = io.BytesIO(buffer)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+    column = np.frombuffer(buffer, dtype = dtype, count = int(np.prod(shape)), 
+                           offset = stream.tell())
+    return column.astype(float, copy = False)
+
+
+def decode_column(column):
+    '''
+    Decodes a column of a columnar payload given as a JSON array, or as a base64 string
+    of little-endian float64 values or of a .npy file. Binary columns are read in place.
+    Raises PayloadError if the column cannot be decoded.
+    '''
+    if isinstance(column, str):
+        try:
+            buffer = base64.b64decode(column)
+        except binascii.Error as error:
+            raise PayloadError(f'A column is not valid base64: {error}')
+        if buffer[:6] == b'\x93NUMPY':
+            try:
+                return read_npy(buffer)
+            except (TypeError, ValueError) as error:
+                raise PayloadError(f'A column is not a valid .npy file: {error}')
+        if len(buffer) % 8 != 0:
+            raise PayloadError('A binary column must be a whole number of float64 values.')
+        return np.frombuffer(buffer, dtype = '<f8')
+    try:
+        column = np.asarray(column, dtype = float)
+    except (TypeError, ValueError) as error:
+        raise PayloadError(f'A column is not a list of numbers: {error}')
+    if column.ndim != 1:
+        raise PayloadError('A column must be a flat list of numbers.')
+    return column
+
+
+def decode_preferences(preferences):
+    '''
+    Decodes a columnar preferences payload, a list with one {breakpoints, startValue, 
+    endValue} or {breakpoints, values} dict of columns per agent. Preferences given as 
+    lists of segment dicts are returned unchanged. Raises PayloadError if the payload 
+    is malformed.
+    '''
+    if not (isinstance(preferences, list) and len(preferences) > 0 and 
+            isinstance(preferences[0], dict)):
+        return preferences
+    agents = []
+    for agent_columns in preferences:
+        if not isinstance(agent_columns, dict):
+            raise PayloadError('Each agent of a columnar payload must be an object.')
+        if 'breakpoints' not in agent_columns or not ('values' in agent_columns or 
+            ('startValue' in agent_columns and 'endValue' in agent_columns)):
+            raise PayloadError('Each agent needs breakpoints and either values or '
+                               'startValue and endValue.')
+        breakpoints = decode_column(agent_columns['breakpoints'])
+        if 'values' in agent_columns:
+            start_values = decode_column(agent_columns['values'])
+            end_values = start_values
+        else:
+            start_values = decode_column(agent_columns['startValue'])
+            end_values = decode_column(agent_columns['endValue'])
+        if not (len(breakpoints) == len(start_values) + 1 == len(end_values) + 1):
+            raise PayloadError('Each agent needs one more breakpoint than values.')
+        agents.append((breakpoints[:-1], breakpoints[1:], start_values, end_values))
+    return ColumnarPreferences(agents)
+#Preprocessing above
+
+#ValueQuery Stuff below
 
 def one_sided_query(agent, prefs, end):
     '''
     Performs an eval query between 0 and the inputted end value.
     '''
-    segments = np.size(prefs[agent])
-    value = 0
-    for i in range(segments):
-        if end > prefs[agent][i]['end']:
-            value += find_full_value(prefs[agent][i])
-        if end <= prefs[agent][i]['end']:
-            value += find_partial_value_right_side(prefs[agent][i], end)
-            return value
+    prefs = compile_preferences(prefs)
+    return prefs[agent].cumulative_value(end)
         
 
 def check_valid_bounds(start,end):
@@ -150,6 +407,7 @@ def check_valid_bounds(start,end):
         "invalid bounds. start and end should be between 0 and 1."
 
 
+@counted('value_query_initial')
 def value_query_initial(agent, prefs, start, end):
     '''
     Performs the eval query before modifications.
@@ -158,22 +416,9 @@ def value_query_initial(agent, prefs, start, end):
         value = 0
         return value
     else:
-        segments = np.size(prefs[agent])
-        value = 0
-        for i in range(segments):
-            if start >= prefs[agent][i]['end']:
-                continue
-            if start >= prefs[agent][i]['start'] and end <= prefs[agent][i]['end']:
-                value = find_partial_value_two_sided(prefs[agent][i], start, end)
-                return value
-            if start >= prefs[agent][i]['start'] and end > prefs[agent][i]['end']:
-                value += find_partial_value_left_side(prefs[agent][i], start)
-                continue
-            if start < prefs[agent][i]['start'] and end > prefs[agent][i]['end']:
-                value += find_full_value(prefs[agent][i])
-            if start < prefs[agent][i]['start'] and end <= prefs[agent][i]['end']:
-                value += find_partial_value_right_side(prefs[agent][i], end)
-                return value
+        prefs = compile_preferences(prefs)
+        value = prefs[agent].value(start, end)
+        return value
     
 
 def value_query_hungry(agent, prefs, start, end, epsilon):
@@ -185,18 +430,35 @@ def value_query_hungry(agent, prefs, start, end, epsilon):
     return value
 
 
+def grid_value_query(agent, prefs, start, end, epsilon):
+    '''
+    Performs value_query_hungry between two points of the epsilon grid. The result is
+    cached on the compiled preferences under the grid indices of start and end so that
+    each grid evaluation is only computed once per run. It is computed at the grid 
+    points of those indices, so it does not depend on which query filled the cache.
+    '''
+    prefs = compile_preferences(prefs)
+    key = (agent, round(start / epsilon), round(end / epsilon))
+    value = prefs.grid_cache.get(key)
+    if value is None:
+        value = value_query_hungry(agent, prefs, key[1] * epsilon, key[2] * epsilon, 
+                                   epsilon)
+        prefs.grid_cache.put(key, value)
+    return value
+
+
 def intermediate_queries_variant_one(agent, prefs, start_bounds, 
                                      end_bounds, epsilon):
     '''
     Finds the intermediate value queries for the first variant of the 
     first variant of the eval query defined by Hollender-Rubinstein.
     '''
-    query_one = value_query_hungry(agent, prefs, start_bounds.lower, 
-                                end_bounds.lower, epsilon)
-    query_two = value_query_hungry(agent, prefs, start_bounds.lower, 
-                                end_bounds.upper, epsilon)
-    query_three = value_query_hungry(agent, prefs, start_bounds.upper, 
-                                  end_bounds.lower, epsilon)
+    query_one = grid_value_query(agent, prefs, start_bounds.lower, 
+                                 end_bounds.lower, epsilon)
+    query_two = grid_value_query(agent, prefs, start_bounds.lower, 
+                                 end_bounds.upper, epsilon)
+    query_three = grid_value_query(agent, prefs, start_bounds.upper, 
+                                   end_bounds.lower, epsilon)
     return query_one, query_two, query_three
 
 
@@ -206,31 +468,39 @@ def intermediate_queries_variant_two(agent, prefs, start_bounds,
     Finds the intermediate value queries for the first variant of the 
     second variant of the eval query defined by Hollender-Rubinstein.
     '''
-    query_one = value_query_hungry(agent, prefs, start_bounds.upper, 
-                                   end_bounds.upper, epsilon)
-    query_two = value_query_hungry(agent, prefs, start_bounds.lower, 
-                                   end_bounds.upper, epsilon)
-    query_three = value_query_hungry(agent, prefs, start_bounds.upper, 
-                                     end_bounds.lower, epsilon)
+    query_one = grid_value_query(agent, prefs, start_bounds.upper, 
+                                 end_bounds.upper, epsilon)
+    query_two = grid_value_query(agent, prefs, start_bounds.lower, 
+                                 end_bounds.upper, epsilon)
+    query_three = grid_value_query(agent, prefs, start_bounds.upper, 
+                                   end_bounds.lower, epsilon)
     return query_one, query_two, query_three
 
 
+def grid_index(position, epsilon):
+    '''
+    Returns the index of the epsilon grid cell that contains the position, counting a 
+    position on a grid point as in the cell that starts there.
+    '''
+    return floor(position / epsilon + GRID_TOLERANCE)
+
+
+def grid_cell(position, epsilon):
+    '''
+    Returns the index of the grid cell containing the position, with the end of the 
+    cake in the last cell.
+    '''
+    return min(grid_index(position, epsilon), round(1 / epsilon) - 1)
+
+
 def piecewise_linear_bounds(start, end, epsilon):
     '''
     Finds the bounds on the epsilon grid that surround the start and endpoints inputted.
     '''
-    if start != 1:
-        start_lower_bound = (start // epsilon) * epsilon
-        start_upper_bound = start_lower_bound + epsilon 
-    else:
-        start_lower_bound = 1 - epsilon
-        start_upper_bound = 1
-    if end != 1:
-        end_lower_bound = (end // epsilon) * epsilon
-        end_upper_bound = end_lower_bound + epsilon
-    else:
-        end_lower_bound = 1 - epsilon
-        end_upper_bound = 1
+    start_lower_bound = grid_cell(start, epsilon) * epsilon
+    start_upper_bound = start_lower_bound + epsilon 
+    end_lower_bound = grid_cell(end, epsilon) * epsilon
+    end_upper_bound = end_lower_bound + epsilon
 
     start_bounds = Bounds(start_lower_bound, start_upper_bound)
     end_bounds = Bounds(end_lower_bound, end_upper_bound)
@@ -268,6 +538,7 @@ def value_query_variant_two(agent, prefs, start, end, queries, epsilon):
     return component_one + component_two + component_three
 
 
+@counted('value_query')
 def value_query(agent, prefs, start, end, epsilon, queries = [None, None]):
     '''
     Identifies which value query variant to perform and then finds the value.
@@ -279,7 +550,65 @@ def value_query(agent, prefs, start, end, epsilon, queries = [None, None]):
         return value_query_variant_one(agent, prefs, start, end, queries[0], epsilon)
     if start_bounds.upper - start < end - end_bounds.lower:
         return value_query_variant_two(agent, prefs, start, end, queries[1], epsilon)
-    
+
+
+def batch_value_query_hungry(agents, prefs, starts, ends, epsilon):
+    '''
+    Vectorised value_query_hungry for arrays of agents, starts and ends.
+    '''
+    initial_values = np.zeros(np.shape(starts))
+    for agent in np.unique(agents):
+        mask = (agents == agent) & (ends > starts)
+        initial_values[mask] = \
+            prefs[agent].cumulative_values(ends[mask]) - \
+            prefs[agent].cumulative_values(starts[mask])
+    return initial_values / 2 + epsilon * (ends - starts)
+
+
+def batch_piecewise_linear_bounds(cuts, epsilon):
+    '''
+    Vectorised piecewise_linear_bounds for a single array of cut positions.
+    '''
+    cells = np.minimum(np.floor(cuts / epsilon + GRID_TOLERANCE), round(1 / epsilon) - 1)
+    lower_bounds = cells * epsilon
+    upper_bounds = lower_bounds + epsilon
+    return lower_bounds, upper_bounds
+
+
+def batch_value_query(agents, prefs, starts, ends, epsilon):
+    '''
+    Performs the Hollender-Rubinstein value query for arrays of agents, starts and
+    ends in one pass. Returns the same values as calling value_query on each triple.
+    '''
+    prefs = compile_preferences(prefs)
+    agents, starts, ends = np.broadcast_arrays(np.asarray(agents), 
+                                               np.asarray(starts, dtype=float), 
+                                               np.asarray(ends, dtype=float))
+    count_queries('value_query', agents)
+    assert np.all((starts >= 0) & (starts <= 1) & (ends >= 0) & (ends <= 1)), \
+        "invalid bounds. start and end should be between 0 and 1."
+    start_lower, start_upper = batch_piecewise_linear_bounds(starts, epsilon)
+    end_lower, end_upper = batch_piecewise_linear_bounds(ends, epsilon)
+    start_offset = start_upper - starts
+    end_offset = ends - end_lower
+    variant_one = start_offset >= end_offset
+
+    #Variant one uses the lower end corner where variant two uses the upper one.
+    query_zero_starts = np.where(variant_one, start_lower, start_upper)
+    query_zero_ends = np.where(variant_one, end_lower, end_upper)
+    query_zero = batch_value_query_hungry(agents, prefs, query_zero_starts, 
+                                          query_zero_ends, epsilon)
+    query_one = batch_value_query_hungry(agents, prefs, start_lower, end_upper, epsilon)
+    query_two = batch_value_query_hungry(agents, prefs, start_upper, end_lower, epsilon)
+
+    values_one = ((start_offset - end_offset) / epsilon) * query_zero + \
+                 (end_offset / epsilon) * query_one + \
+                 ((starts - start_lower) / epsilon) * query_two
+    values_two = ((end_offset - start_offset) / epsilon) * query_zero + \
+                 (start_offset / epsilon) * query_one + \
+                 ((end_upper - ends) / epsilon) * query_two
+    return np.where(variant_one, values_one, values_two)
+
 #Value Query stuff above
 
 #Cut Query Stuff Below
@@ -290,15 +619,13 @@ def start_cut_query(agent, prefs, end, value, epsilon, bounds, queries):
     and slice value.
     '''
     if bounds is None:
-        start_cut_bounds = Bounds(0, end)
-        count = 0
-        while (start_cut_bounds.upper // epsilon) != (start_cut_bounds.lower // epsilon):
-            start_cut_bounds = start_cut_bounds_update(agent, prefs, end, start_cut_bounds, 
-                                                    value, epsilon)
-            count += 1
-            if count >= 52:
-                break #Breaks in the event that the exit condition is not reached as a result of 
-                      #floating point error.
+        start_cut_bounds = start_cut_epsilon_interval(agent, prefs, end, value, epsilon)
+        if start_cut_bounds is None:
+            start_cut_bounds = GridBounds(0, end, epsilon)
+            while start_cut_bounds.converged() == False:
+                start_cut_bounds = start_cut_bounds_update(agent, prefs, end, start_cut_bounds, 
+                                                        value, epsilon)
+            start_cut_bounds = start_cut_bounds.epsilon_interval()
     else:
         start_cut_bounds = bounds
     start = start_cut_bounds.midpoint()
@@ -387,21 +714,50 @@ def start_cut_bounds_update(agent, prefs, end, start_cut_bounds,
     return start_cut_bounds
 
 
+def interpolated_hungry_cumulative_value(agent, prefs, cut, epsilon):
+    '''
+    Interpolates the hungry cumulative value between the epsilon grid points around
+    the cut. This is the part of a value query evaluated at a grid point that depends
+    on the other cut.
+    '''
+    prefs = compile_preferences(prefs)
+    cut_bounds, _ = piecewise_linear_bounds(cut, cut, epsilon)
+    weight = (cut - cut_bounds.lower) / epsilon
+    return ((1 - weight) * prefs[agent].hungry_cumulative_value(cut_bounds.lower, epsilon) + 
+            weight * prefs[agent].hungry_cumulative_value(cut_bounds.upper, epsilon))
+
+
+def start_cut_epsilon_interval(agent, prefs, end, value, epsilon):
+    '''
+    Finds the epsilon interval of the start cut in closed form. For a start cut on the 
+    grid the value query is the interpolated hungry cumulative value at the end minus 
+    the hungry cumulative value at the start, so the interval follows from inverting 
+    the latter. Returns None if the cut is within a cell of the end, where this 
+    does not hold.
+    '''
+    prefs = compile_preferences(prefs)
+    _, end_bounds = piecewise_linear_bounds(end, end, epsilon)
+    target = interpolated_hungry_cumulative_value(agent, prefs, end, epsilon) - value
+    start = prefs[agent].inverse_hungry_cumulative_value(target, epsilon)
+    cell = grid_cell(start, epsilon)
+    if cell >= round(end_bounds.lower / epsilon):
+        return None
+    return Bounds(cell * epsilon, cell * epsilon + epsilon)
+
+
 def end_cut_query(agent, prefs, start, value, epsilon, bounds, queries):
     '''
     Performs a query that finds the associated end cut for an inputted start cut
     and slice value.
     '''
     if bounds is None:
-        end_cut_bounds = Bounds(start, 1)
-        count = 0
-        while (end_cut_bounds.upper // epsilon) != (end_cut_bounds.lower // epsilon):
-            end_cut_bounds = end_cut_bounds_update(agent, prefs, start, end_cut_bounds, 
-                                                value, epsilon)
-            count += 1
-            if count >= 52:
-                break #Breaks in the event that the exit condition is not reached as a result of 
-                      #floating point error.
+        end_cut_bounds = end_cut_epsilon_interval(agent, prefs, start, value, epsilon)
+        if end_cut_bounds is None:
+            end_cut_bounds = GridBounds(start, 1, epsilon)
+            while end_cut_bounds.converged() == False:
+                end_cut_bounds = end_cut_bounds_update(agent, prefs, start, end_cut_bounds, 
+                                                    value, epsilon)
+            end_cut_bounds = end_cut_bounds.epsilon_interval()
     else:
         end_cut_bounds = bounds
     end = end_cut_bounds.midpoint()
@@ -489,6 +845,22 @@ def end_cut_bounds_update(agent, prefs, start, end_cut_bounds,
     return end_cut_bounds
 
 
+def end_cut_epsilon_interval(agent, prefs, start, value, epsilon):
+    '''
+    Finds the epsilon interval of the end cut in closed form, see 
+    start_cut_epsilon_interval. Returns None if the cut is within a cell of the start.
+    '''
+    prefs = compile_preferences(prefs)
+    start_bounds, _ = piecewise_linear_bounds(start, start, epsilon)
+    target = value + interpolated_hungry_cumulative_value(agent, prefs, start, epsilon)
+    end = prefs[agent].inverse_hungry_cumulative_value(target, epsilon)
+    cell = grid_cell(end, epsilon)
+    if cell <= round(start_bounds.lower / epsilon):
+        return None
+    return Bounds(cell * epsilon, cell * epsilon + epsilon)
+
+
+@counted('cut_query')
 def cut_query(agent, prefs, initial_cut, value, epsilon, end_cut = True, 
               bounds = None, queries = None):
     '''
@@ -502,23 +874,21 @@ def cut_query(agent, prefs, initial_cut, value, epsilon, end_cut = True,
     return queried_cut
 
 
+@counted('bisection_cut_query')
 def bisection_cut_query(agent, prefs, start, end, epsilon):
     '''
     Performs a query that bisects a slice by value between a start and end cut.
     '''
     if start == end:
         return start
-    bisection_cut_bounds = Bounds(start, end)
-    count = 0
-    while (bisection_cut_bounds.upper // epsilon) != (bisection_cut_bounds.lower // epsilon):
+    bisection_cut_bounds = GridBounds(start, end, epsilon)
+    while bisection_cut_bounds.converged() == False:
         bisection_cut_bounds = \
             bisection_cut_bounds_update(agent, prefs, start, end,
                                         bisection_cut_bounds, epsilon)
-        count += 1
-        if count >= 52:
-            break #Breaks in the event that the exit condition is not reached as a result of 
-                  #floating point error.
-    bisection_cut = find_bisection_cut(agent, prefs, start, bisection_cut_bounds, end, epsilon)
+    bisection_cut = find_bisection_cut(agent, prefs, start, 
+                                       bisection_cut_bounds.epsilon_interval(), 
+                                       end, epsilon)
     return bisection_cut
 
 def bisection_cut_bounds_update(agent, prefs, start, end, 
@@ -859,7 +1229,7 @@ def find_epsilon_interval(bounds, epsilon):
     Finds the epsilon interval that two bounds are sandwiched between.
     '''
     value_within_interval = bounds.midpoint()
-    lower_bound_of_interval = (value_within_interval // epsilon) * epsilon
+    lower_bound_of_interval = grid_index(value_within_interval, epsilon) * epsilon
     upper_bound_of_interval = lower_bound_of_interval + epsilon 
     epsilon_interval = Bounds(lower_bound_of_interval, upper_bound_of_interval)
     return epsilon_interval
@@ -995,22 +1365,24 @@ def find_cut_epsilon_interval(prefs, agents_number, epsilon, cut_bounds_update):
     '''
     Finds epsilon interval of a cut according to the inputted cut bound update function.
     '''
-    cut_bounds = Bounds(0, 1)
-    count = 0
-    while (cut_bounds.upper // epsilon) != (cut_bounds.lower // epsilon):
+    cut_bounds = GridBounds(0, 1, epsilon)
+    while cut_bounds.converged() == False:
         cut_bounds = cut_bounds_update(prefs, cut_bounds, agents_number, epsilon)
-        count += 1
-        if count >= 52:
-            break
-    cut_epsilon_interval = find_epsilon_interval(cut_bounds, epsilon)
+    cut_epsilon_interval = cut_bounds.epsilon_interval()
     return cut_epsilon_interval
 
 
+@timed('equipartition')
 def compute_equipartition(prefs, agents_number, epsilon):
     '''
     Finds the epsilon interval of the left, right, and optionally middle cut for the 
-    equipartition. Then finds the exact positions via caching.
+    equipartition. Then finds the exact positions via caching. Only agent 0 is queried,
+    so the result is kept on the compiled preferences for as long as agent 0 is unchanged.
     '''
+    prefs = compile_preferences(prefs)
+    key = (agents_number, epsilon)
+    if key in prefs.equipartitions:
+        return prefs.equipartitions[key]
     left_cut_bounds = find_cut_epsilon_interval(prefs, agents_number, epsilon,
                                                 left_cut_bounds_update)
     if agents_number == 3:
@@ -1031,6 +1403,7 @@ def compute_equipartition(prefs, agents_number, epsilon):
         equipartition = \
             exact_equipartition_cuts_four_agents(prefs, left_cut_bounds, middle_cut_bounds,
                                                  right_cut_bounds, epsilon)
+    prefs.equipartitions[key] = equipartition
     return equipartition
 
 #Equipartition stuff above
@@ -1044,35 +1417,36 @@ def check_valid_agents_value(agents_number):
     
 #slice value stuff below. "
 
-def find_middle_slice_values(agent, prefs, division, agents_number, epsilon):
+def division_cuts(division, agents_number):
     '''
-    Finds slice 2 in the three agent case and slice 2 and 3 in the four agent case.
+    Returns the cut positions of a division including the ends of the cake.
     '''
     if agents_number == 3:
-        middle_slice_values = np.array([value_query(agent, prefs, division.left, 
-                                                    division.right, epsilon)])
+        return np.array([0, division.left, division.right, 1], dtype=float)
     if agents_number == 4:
-        slice_two_value = value_query(agent, prefs, division.left, 
-                                      division.middle, epsilon)
-        slice_three_value = value_query(agent, prefs, division.middle, 
-                                      division.right, epsilon)
-        middle_slice_values = np.array([slice_two_value, slice_three_value])
-    return middle_slice_values
+        return np.array([0, division.left, division.middle, division.right, 1], 
+                        dtype=float)
+
+
+def slice_value_matrix(prefs, division, agents_number, epsilon, agents = None):
+    '''
+    Finds the slice values of every inputted agent (all agents by default) for a 
+    division with one batched value query. Row i holds the slice values of agents[i].
+    '''
+    check_valid_agents_value(agents_number)
+    if agents is None:
+        agents = np.arange(agents_number)
+    cuts = division_cuts(division, agents_number)
+    agents = np.asarray(agents)[:, np.newaxis]
+    return batch_value_query(agents, prefs, cuts[np.newaxis, :-1], 
+                             cuts[np.newaxis, 1:], epsilon)
 
 
 def slice_values(agent, prefs, division, agents_number, epsilon):
     '''
     Finds the slice values for an inputted agent and division.
     '''
-    check_valid_agents_value(agents_number)
-    left_slice_value = np.array([value_query(agent, prefs, 0, division.left, 
-                                             epsilon)])
-    middle_slice_values = find_middle_slice_values(agent, prefs, division, 
-                                                   agents_number, epsilon)
-    right_slice_value = np.array([value_query(agent, prefs, division.right, 1, 
-                                              epsilon)])
-    return np.concatenate([left_slice_value, middle_slice_values, 
-                           right_slice_value])
+    return slice_value_matrix(prefs, division, agents_number, epsilon, [agent])[0]
 
 #slice value stuff above
 
@@ -1092,8 +1466,8 @@ def invariant_three_agent_check(slice, prefs, division, epsilon):
     '''
     Old code for monotone branzei nisan. Checks that agents 2 and 3 prefer the same slice.
     '''
-    agent_one_slice_values = slice_values(1, prefs, division, 3, epsilon)
-    agent_two_slice_values = slice_values(2, prefs, division, 3, epsilon)
+    agent_one_slice_values, agent_two_slice_values = \
+        slice_value_matrix(prefs, division, 3, epsilon, [1, 2])
     
     if  ((agent_one_slice_values[slice-1] == np.max(agent_one_slice_values)) and \
         (agent_two_slice_values[slice-1] == np.max(agent_two_slice_values))):
@@ -1154,6 +1528,7 @@ def invariant_three_agents_slice_three_preferred(prefs, alpha, epsilon):
         return invariant_three_agent_check(3, prefs, division, epsilon)
 
 
+@timed('invariant')
 def check_invariant_three_agents(prefs, alpha, epsilon):
     '''
     Old code for the monotone branzei nisan. Checks if the invariant is true for Branzei nisan.
@@ -1168,26 +1543,32 @@ def check_invariant_three_agents(prefs, alpha, epsilon):
         return False, 0
 
 
-def division_three_agents(prefs, alpha, epsilon):
+def slice_division_three_agents(prefs, alpha, slices, epsilon):
     '''
-    Old code for monotone branzei nisan. Checks which slice two agents prefer. To
-    be returned to the website for the information in the results window.
+    Old code for monotone branzei nisan. Returns the division where agent one values 
+    every slice but the one agents two and three prefer at alpha.
     '''
-    if check_invariant_three_agents(prefs, alpha, epsilon)[1] == 1:
+    if slices == 1:
         right_cut = cut_query(0, prefs, 1, alpha, epsilon, end_cut = False)
         left_cut = cut_query(0, prefs, right_cut, alpha, 
                              epsilon, end_cut = False)
-        slices = 1
-    if check_invariant_three_agents(prefs, alpha, epsilon)[1] == 2:
+    if slices == 2:
         left_cut = cut_query(0, prefs, 0, alpha, epsilon)
         right_cut = cut_query(0, prefs, 1, alpha, epsilon, end_cut = False)
-        slices = 2
-    if check_invariant_three_agents(prefs, alpha, epsilon)[1] == 3:
+    if slices == 3:
         left_cut = cut_query(0, prefs, 0, alpha, epsilon)
         right_cut = cut_query(0, prefs, left_cut, alpha, epsilon)
-        slices = 3
-    division = ThreeAgentPortion(left_cut,right_cut)
-    return division, slices
+    return ThreeAgentPortion(left_cut,right_cut)
+
+
+@timed('division')
+def division_three_agents(prefs, alpha, epsilon):
+    '''
+    Old code for monotone branzei nisan. Checks which slice two agents prefer. To
+    be returned to the website for the information in the results window.
+    '''
+    slices = check_invariant_three_agents(prefs, alpha, epsilon)[1]
+    return slice_division_three_agents(prefs, alpha, slices, epsilon), slices
     
 #3 agent invariant checks above
 
@@ -1211,6 +1592,7 @@ def check_unique_preferences_three_agent(agent_one_slice_values,
     return False
 
 
+@timed('envy_free_check')
 def check_equipartition_envy_free_three_agents(prefs, alpha, 
                                                agents_number, epsilon):
     '''
@@ -1220,10 +1602,8 @@ def check_equipartition_envy_free_three_agents(prefs, alpha,
     left_cut = cut_query(0, prefs, 0, alpha, epsilon)
     right_cut = cut_query(0, prefs, left_cut, alpha, epsilon)
     division = ThreeAgentPortion(left_cut,right_cut)
-    agent_one_slice_values = slice_values(1, prefs, division, agents_number,
-                                          epsilon)
-    agent_two_slice_values = slice_values(2, prefs, division, agents_number,
-                                          epsilon)
+    agent_one_slice_values, agent_two_slice_values = \
+        slice_value_matrix(prefs, division, agents_number, epsilon, [1, 2])
     is_envy_free = check_unique_preferences_three_agent(agent_one_slice_values,
                                                         agent_two_slice_values)
     return is_envy_free
@@ -1250,6 +1630,7 @@ def check_unique_preferences_four_agent(agent_one_slice_values,
     return False
 
 
+@timed('envy_free_check')
 def check_equipartition_envy_free_four_agents(prefs, alpha, agents_number, epsilon):
     '''
     Checks if the division is approximately envy-free after equipartition.
@@ -1258,9 +1639,8 @@ def check_equipartition_envy_free_four_agents(prefs, alpha, agents_number, epsil
     middle_cut = cut_query(0, prefs, left_cut, alpha, epsilon)
     right_cut = cut_query(0, prefs, middle_cut, alpha, epsilon)
     division = FourAgentPortion(left_cut, middle_cut, right_cut)
-    agent_one_slice_values = slice_values(1, prefs, division, agents_number, epsilon)
-    agent_two_slice_values = slice_values(2, prefs, division, agents_number, epsilon)
-    agent_three_slice_values = slice_values(3, prefs, division, agents_number, epsilon)
+    agent_one_slice_values, agent_two_slice_values, agent_three_slice_values = \
+        slice_value_matrix(prefs, division, agents_number, epsilon, [1, 2, 3])
     is_envy_free = check_unique_preferences_four_agent(agent_one_slice_values,
                                                        agent_two_slice_values,
                                                        agent_three_slice_values)
@@ -1285,10 +1665,7 @@ def condition_a_check(slice, prefs, alpha, division, epsilon):
     Checks if condition A of the invariant is true for the Hollender-Rubinstein algorithm.
     '''
     agents_number = 4
-    slices_number = 4
-    agent_slice_values = np.zeros((agents_number,slices_number))
-    for k in range(agents_number):
-        agent_slice_values[k] = slice_values(k, prefs, division, 4, epsilon)
+    agent_slice_values = slice_value_matrix(prefs, division, 4, epsilon)
     for i in range(1, agents_number):
         for j in range(1, agents_number):
             if j == i:
@@ -1302,124 +1679,119 @@ def condition_a_check(slice, prefs, alpha, division, epsilon):
     return False
             
 
-def condition_a_slice_one_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_a_slice_one_preferred(prefs, alpha, epsilon):
     '''
     Checks if two or more agents prefer slice one for the Hollender-Rubinstein algorithm.
     '''
     right_cut = cut_query(0, prefs, 1, alpha, epsilon, end_cut = False)
     if right_cut is None:
-        return False
+        return InvariantResult(False)
     middle_cut = cut_query(0, prefs, right_cut, alpha, epsilon, end_cut = False)
     if middle_cut is None:
-        return False
+        return InvariantResult(False)
     left_cut = cut_query(0, prefs, middle_cut, alpha, epsilon, end_cut = False)
     if left_cut is None:
-        return False
+        return InvariantResult(False)
     division = FourAgentPortion(left_cut, middle_cut, right_cut)
     if check_valid_division(division) == False:
-        return False
-    check_value = condition_a_check(1, prefs, alpha, division, epsilon)
-    if (check_value == True) and (return_division == True):
-        info = pd.DataFrame({'condition': 1,
-                             'slices': [1],
-                             'indifferent_agent': None})
-        return division, info
-    else:
-        return check_value
+        return InvariantResult(False)
+    if condition_a_check(1, prefs, alpha, division, epsilon) == False:
+        return InvariantResult(False)
+    info = pd.DataFrame({'condition': 1,
+                         'slices': [1],
+                         'indifferent_agent': None})
+    return InvariantResult(True, division, info)
     
 
-def condition_a_slice_two_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_a_slice_two_preferred(prefs, alpha, epsilon):
     '''
     Checks if two or more agents prefer slice two for the Hollender-Rubinstein algorithm.
     '''
     left_cut = cut_query(0, prefs, 0, alpha, epsilon, end_cut = True)
     if left_cut is None:
-        return False
+        return InvariantResult(False)
     right_cut = cut_query(0, prefs, 1, alpha, epsilon, end_cut = False)
     if right_cut is None:
-        return False
+        return InvariantResult(False)
     middle_cut = cut_query(0, prefs, right_cut, alpha, epsilon, end_cut = False)
     if middle_cut is None:
-        return False
+        return InvariantResult(False)
     division = FourAgentPortion(left_cut, middle_cut, right_cut)
     if check_valid_division(division) == False:
-        return False
-    check_value = condition_a_check(2, prefs, alpha, division, epsilon)
-    if (check_value == True) and (return_division == True):
-        info = pd.DataFrame({'condition': 1,
-                             'slices': [2],
-                             'indifferent_agent': None})
-        return division, info
-    else:
-        return check_value
+        return InvariantResult(False)
+    if condition_a_check(2, prefs, alpha, division, epsilon) == False:
+        return InvariantResult(False)
+    info = pd.DataFrame({'condition': 1,
+                         'slices': [2],
+                         'indifferent_agent': None})
+    return InvariantResult(True, division, info)
     
 
-def condition_a_slice_three_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_a_slice_three_preferred(prefs, alpha, epsilon):
     '''
     Checks if two or more agents prefer slice three for the Hollender-Rubinstein algorithm.
     '''
     left_cut = cut_query(0, prefs, 0, alpha, epsilon, end_cut = True)
     if left_cut is None:
-        return False
+        return InvariantResult(False)
     middle_cut = cut_query(0, prefs, left_cut, alpha, epsilon, end_cut = True)
     if middle_cut is None:
-        return False
+        return InvariantResult(False)
     right_cut = cut_query(0, prefs, 1, alpha, epsilon, end_cut = False)
     if right_cut is None:
-        return False
+        return InvariantResult(False)
     division = FourAgentPortion(left_cut, middle_cut, right_cut)
     if check_valid_division(division) == False:
-        return False
-    check_value = condition_a_check(3, prefs, alpha, division, epsilon)
-    if (check_value == True) and (return_division == True):
-        info = pd.DataFrame({'condition': 1,
-                             'slices': [3],
-                             'indifferent_agent': None})
-        return division, info
-    else:
-        return check_value
+        return InvariantResult(False)
+    if condition_a_check(3, prefs, alpha, division, epsilon) == False:
+        return InvariantResult(False)
+    info = pd.DataFrame({'condition': 1,
+                         'slices': [3],
+                         'indifferent_agent': None})
+    return InvariantResult(True, division, info)
     
 
-def condition_a_slice_four_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_a_slice_four_preferred(prefs, alpha, epsilon):
     '''
     Checks if two or more agents prefer slice four for the Hollender-Rubinstein algorithm.
     '''
     left_cut = cut_query(0, prefs, 0, alpha, epsilon, end_cut = True)
     if left_cut is None:
-        return False
+        return InvariantResult(False)
     middle_cut = cut_query(0, prefs, left_cut, alpha, epsilon, end_cut = True)
     if middle_cut is None:
-        return False
+        return InvariantResult(False)
     right_cut = cut_query(0, prefs, middle_cut, alpha, epsilon, end_cut = True)
     if right_cut is None:
-        return False
+        return InvariantResult(False)
     division = FourAgentPortion(left_cut, middle_cut, right_cut)
     if check_valid_division(division) == False:
-        return False
-    check_value = condition_a_check(4, prefs, alpha, division, epsilon)
-    if (check_value == True) and (return_division == True):
-        info = pd.DataFrame({'condition': 1,
-                             'slices': [4],
-                             'indifferent_agent': None})
-        return division, info
-    else:
-        return check_value
+        return InvariantResult(False)
+    if condition_a_check(4, prefs, alpha, division, epsilon) == False:
+        return InvariantResult(False)
+    info = pd.DataFrame({'condition': 1,
+                         'slices': [4],
+                         'indifferent_agent': None})
+    return InvariantResult(True, division, info)
     
 
-def check_condition_a(prefs, alpha, epsilon, return_division = False):
-    '''
-    Runs checks on condition A cases and returns true or false..
-    '''
-    if condition_a_slice_one_preferred(prefs, alpha, epsilon) == True:
-        return condition_a_slice_one_preferred(prefs, alpha, epsilon, return_division)
-    if condition_a_slice_two_preferred(prefs, alpha, epsilon) == True:
-        return condition_a_slice_two_preferred(prefs, alpha, epsilon, return_division)
-    if condition_a_slice_three_preferred(prefs, alpha, epsilon) == True:
-        return condition_a_slice_three_preferred(prefs, alpha, epsilon, return_division)
-    if condition_a_slice_four_preferred(prefs, alpha, epsilon) == True:
-        return condition_a_slice_four_preferred(prefs, alpha, epsilon, return_division)
-    else:
-        return False
+def check_condition_a(prefs, alpha, epsilon):
+    '''
+    Runs checks on condition A cases and returns the first that holds.
+    '''
+    result = condition_a_slice_one_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    result = condition_a_slice_two_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    result = condition_a_slice_three_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    result = condition_a_slice_four_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    return InvariantResult(False)
     
 #condition A checks above.
 
@@ -1430,11 +1802,8 @@ def condition_b_check(slices, prefs, alpha, division, epsilon):
     Checks if condition B of the invariant is true for the Hollender-Rubinstein algorithm.
     '''
     agents_number = 4
-    slices_number = 4
-    agent_slice_values = np.zeros((agents_number,slices_number))
+    agent_slice_values = slice_value_matrix(prefs, division, 4, epsilon)
     slice_check = np.zeros(2)
-    for k in range(agents_number):
-        agent_slice_values[k] = slice_values(k, prefs, division, 4, epsilon)
     for s in range(2):
         for i in range(1, agents_number):
             for j in range(1, agents_number):
@@ -1452,104 +1821,96 @@ def condition_b_check(slices, prefs, alpha, division, epsilon):
         return False
     
 
-def condition_b_slice_one_two_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_b_slice_one_two_preferred(prefs, alpha, epsilon, 
+                                        indifferent_agents = (1, 2, 3)):
     '''
     Checks if slices one and two are each preferred by at least two agents.
     '''
     right_cut = cut_query(0, prefs, 1, alpha, epsilon, end_cut = False)
     if right_cut is None:
-        return False
+        return InvariantResult(False)
     middle_cut = cut_query(0, prefs, right_cut, alpha, epsilon, end_cut = False)
     if middle_cut is None:
-        return False
-    for i in range(1,4):
+        return InvariantResult(False)
+    for i in indifferent_agents:
         left_cut = bisection_cut_query(i, prefs, 0, middle_cut, epsilon)
         division = FourAgentPortion(left_cut, middle_cut, right_cut)
         if check_valid_division(division) == False:
             continue
-        check_value = condition_b_check([1,2], prefs, alpha, division, epsilon)
-        if (check_value == True) and (return_division == True):
-            info = pd.DataFrame({'condition': 2,
-                                 'slices': [1,2],
-                                 'indifferent_agent': i})
-            return division, info
-        if (check_value == True) and (return_division == False):
-            return check_value
-        else:
+        if condition_b_check([1,2], prefs, alpha, division, epsilon) == False:
             continue
-    return False
+        info = pd.DataFrame({'condition': 2,
+                             'slices': [1,2],
+                             'indifferent_agent': i})
+        return InvariantResult(True, division, info)
+    return InvariantResult(False)
 
 
-def condition_b_slice_two_three_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_b_slice_two_three_preferred(prefs, alpha, epsilon):
     '''
     Checks if slices two and three are each preferred by at least two agents.
     '''
     left_cut = cut_query(0, prefs, 0, alpha, epsilon, end_cut = True)
     if left_cut is None:
-        return False
+        return InvariantResult(False)
     right_cut = cut_query(0, prefs, 1, alpha, epsilon, end_cut = False)
     if right_cut is None:
-        return False
+        return InvariantResult(False)
     for i in range(1,4):
         middle_cut = bisection_cut_query(i, prefs, left_cut, right_cut, epsilon)
         if middle_cut is None:
-            return False
+            return InvariantResult(False)
         division = FourAgentPortion(left_cut, middle_cut, right_cut)
         if check_valid_division(division) == False:
             continue
-        check_value = condition_b_check([2,3], prefs, alpha, division, epsilon)
-        if (check_value == True) and (return_division == True):
-            info = pd.DataFrame({'condition': 2,
-                                 'slices': [2,3],
-                                 'indifferent_agent': i})
-            return division, info
-        if (check_value == True) and (return_division == False):
-            return check_value
-        else:
+        if condition_b_check([2,3], prefs, alpha, division, epsilon) == False:
             continue
-    return False
+        info = pd.DataFrame({'condition': 2,
+                             'slices': [2,3],
+                             'indifferent_agent': i})
+        return InvariantResult(True, division, info)
+    return InvariantResult(False)
 
 
-def condition_b_slice_three_four_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_b_slice_three_four_preferred(prefs, alpha, epsilon, 
+                                           indifferent_agents = (1, 2, 3)):
     '''
     Checks if slices three and four are each preferred by at least two agents.
     '''
     left_cut = cut_query(0, prefs, 0, alpha, epsilon, end_cut = True)
     if left_cut is None:
-        return False
+        return InvariantResult(False)
     middle_cut = cut_query(0, prefs, left_cut, alpha, epsilon, end_cut = True)
     if middle_cut is None:
-        return False
-    for i in range(1,4):
+        return InvariantResult(False)
+    for i in indifferent_agents:
         right_cut = bisection_cut_query(i, prefs, middle_cut, 1, epsilon)
         division = FourAgentPortion(left_cut, middle_cut, right_cut)
         if check_valid_division(division) == False:
             continue
-        check_value = condition_b_check([3,4], prefs, alpha, division, epsilon)
-        if (check_value == True) and (return_division == True):
-            info = pd.DataFrame({'condition': 2,
-                                 'slices': [3,4],
-                                 'indifferent_agent': i})
-            return division, info
-        if (check_value == True) and (return_division == False):
-            return check_value
-        else:
+        if condition_b_check([3,4], prefs, alpha, division, epsilon) == False:
             continue
-    return False
+        info = pd.DataFrame({'condition': 2,
+                             'slices': [3,4],
+                             'indifferent_agent': i})
+        return InvariantResult(True, division, info)
+    return InvariantResult(False)
 
 
-def condition_b_adjacent_slices_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_b_adjacent_slices_preferred(prefs, alpha, epsilon):
     '''
     Checks if two adjacent slices are each preferred by at least two agents.
     '''
-    if condition_b_slice_one_two_preferred(prefs, alpha, epsilon) == True:
-        return condition_b_slice_one_two_preferred(prefs, alpha, epsilon, return_division)
-    if condition_b_slice_two_three_preferred(prefs, alpha, epsilon) == True:
-        return condition_b_slice_two_three_preferred(prefs, alpha, epsilon, return_division)
-    if condition_b_slice_three_four_preferred(prefs, alpha, epsilon) == True:
-        return condition_b_slice_three_four_preferred(prefs, alpha, epsilon, return_division)
-    else:
-        return False
+    result = condition_b_slice_one_two_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    result = condition_b_slice_two_three_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    result = condition_b_slice_three_four_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    return InvariantResult(False)
 
 
 def leftmost_cut_bounds_one_apart_update(agent, prefs, leftmost_cut_bounds, 
@@ -1602,17 +1963,13 @@ def non_adjacent_slice_cuts_update(indifferent_agent, prefs, alpha, left_bound,
     Updates the nontrivial cut positions for the case where 
     slices that are non-adjacent are being checked.
     '''
-    cut_bounds = Bounds(left_bound, right_bound)
-    count = 0
-    while (cut_bounds.upper // epsilon) != (cut_bounds.lower // epsilon):
+    cut_bounds = GridBounds(left_bound, right_bound, epsilon)
+    while cut_bounds.converged() == False:
         cut_bounds = \
             cut_bounds_update(indifferent_agent, prefs, 
                               cut_bounds, alpha, left_bound,
                               right_bound, epsilon)
-        count += 1
-        if count >= 52:
-            break
-    cut_epsilon_interval = find_epsilon_interval(cut_bounds, epsilon)
+    cut_epsilon_interval = cut_bounds.epsilon_interval()
     return cut_epsilon_interval
 
 
@@ -1699,68 +2056,63 @@ def one_apart_slice_cuts(indifferent_agent, prefs, alpha, left_bound,
     return leftmost_unknown_cut, rightmost_unknown_cut
 
 
-def condition_b_slice_one_three_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_b_slice_one_three_preferred(prefs, alpha, epsilon, 
+                                          indifferent_agents = (1, 2, 3)):
     '''
     Checks if slices one and three are each preferred by at least two agents.
     '''
     right_cut = cut_query(0, prefs, 1, alpha, epsilon, end_cut = False)
     if right_cut is None:
-        return False
-    for i in range(1,4):
+        return InvariantResult(False)
+    for i in indifferent_agents:
         left_cut, middle_cut = \
             one_apart_slice_cuts(i, prefs, alpha, 0, right_cut, epsilon)
         division = FourAgentPortion(left_cut, middle_cut, right_cut)
         if check_valid_division(division) == False:
             continue
-        check_value = condition_b_check([1,3], prefs, alpha, division, epsilon)
-        if (check_value == True) and (return_division == True):
-            info = pd.DataFrame({'condition': 2,
-                                 'slices': [1,3],
-                                 'indifferent_agent': i})
-            return division, info
-        if (check_value == True) and (return_division == False):
-            return check_value
-        else:
+        if condition_b_check([1,3], prefs, alpha, division, epsilon) == False:
             continue
-    return False
+        info = pd.DataFrame({'condition': 2,
+                             'slices': [1,3],
+                             'indifferent_agent': i})
+        return InvariantResult(True, division, info)
+    return InvariantResult(False)
 
 
-def condition_b_slice_two_four_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_b_slice_two_four_preferred(prefs, alpha, epsilon, 
+                                         indifferent_agents = (1, 2, 3)):
     '''
     Checks if slices two and four are each preferred by at least two agents.
     '''
     left_cut = cut_query(0, prefs, 0, alpha, epsilon, end_cut = True)
     if left_cut is None:
-        return False
-    for i in range(1,4):
+        return InvariantResult(False)
+    for i in indifferent_agents:
         middle_cut, right_cut = \
             one_apart_slice_cuts(i, prefs, alpha, left_cut, 1, epsilon)
         division = FourAgentPortion(left_cut, middle_cut, right_cut)
         if check_valid_division(division) == False:
             continue
-        check_value = condition_b_check([2,4], prefs, alpha, division, epsilon)
-        if (check_value == True) and (return_division == True):
-            info = pd.DataFrame({'condition': 2,
-                                 'slices': [2,4],
-                                 'indifferent_agent': i})
-            return division, info
-        if (check_value == True) and (return_division == False):
-            return check_value
-        else:
+        if condition_b_check([2,4], prefs, alpha, division, epsilon) == False:
             continue
-    return False
+        info = pd.DataFrame({'condition': 2,
+                             'slices': [2,4],
+                             'indifferent_agent': i})
+        return InvariantResult(True, division, info)
+    return InvariantResult(False)
 
 
-def condition_b_one_apart_slices_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_b_one_apart_slices_preferred(prefs, alpha, epsilon):
     '''
     Checks if two slices one apart are each preferred by at least two agents.
     '''
-    if condition_b_slice_one_three_preferred(prefs, alpha, epsilon) == True:
-        return condition_b_slice_one_three_preferred(prefs, alpha, epsilon, return_division)
-    if condition_b_slice_two_four_preferred(prefs, alpha, epsilon) == True:
-        return condition_b_slice_two_four_preferred(prefs, alpha, epsilon, return_division)
-    else:
-        return False
+    result = condition_b_slice_one_three_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    result = condition_b_slice_two_four_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    return InvariantResult(False)
     
 
 def left_cut_bounds_two_apart_update(agent, prefs, 
@@ -1934,87 +2286,135 @@ def two_apart_slice_cuts(indifferent_agent, prefs, alpha, epsilon):
     return left_cut, middle_cut, right_cut
 
 
-def condition_b_slice_one_four_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_b_slice_one_four_preferred(prefs, alpha, epsilon, 
+                                         indifferent_agents = (1, 2, 3)):
     '''
     Checks if slices one and four are each preferred by at least two agents.
     '''
-    for i in range(1,4):
+    for i in indifferent_agents:
         left_cut, middle_cut, right_cut = \
             two_apart_slice_cuts(i, prefs, alpha, epsilon)
         division = FourAgentPortion(left_cut, middle_cut, right_cut)
         if check_valid_division(division) == False:
             continue
-        check_value = condition_b_check([1,4], prefs, alpha, division, epsilon)
-        if (check_value == True) and (return_division == True):
-            info = pd.DataFrame({'condition': 2,
-                                 'slices': [1,4],
-                                 'indifferent_agent': i})
-            return division, info
-        if (check_value == True) and (return_division == False):
-            return check_value
-        else:
+        if condition_b_check([1,4], prefs, alpha, division, epsilon) == False:
             continue
-    return False
+        info = pd.DataFrame({'condition': 2,
+                             'slices': [1,4],
+                             'indifferent_agent': i})
+        return InvariantResult(True, division, info)
+    return InvariantResult(False)
 
 
-def condition_b_two_apart_slices_preferred(prefs, alpha, epsilon, return_division = False):
+def condition_b_two_apart_slices_preferred(prefs, alpha, epsilon):
     '''
     Checks if two slices two apart are each preferred by at least two agents.
     '''
-    if condition_b_slice_one_four_preferred(prefs, alpha, epsilon) == True:
-        return condition_b_slice_one_four_preferred(prefs, alpha, epsilon, return_division)
-    else:
-        return False
+    return condition_b_slice_one_four_preferred(prefs, alpha, epsilon)
     
 
-def check_condition_b(prefs, alpha, epsilon, return_division = False):
+def check_condition_b(prefs, alpha, epsilon):
     '''
     Checks if condition B is true for the Hollender-Rubinstein algorithm.
     '''
-    if condition_b_adjacent_slices_preferred(prefs, alpha, epsilon) == True:
-        return condition_b_adjacent_slices_preferred(prefs, alpha, epsilon, return_division)
-    if condition_b_one_apart_slices_preferred(prefs, alpha, epsilon) == True:
-        return condition_b_one_apart_slices_preferred(prefs, alpha, epsilon, return_division)
-    if condition_b_two_apart_slices_preferred(prefs, alpha, epsilon) == True:
-        return condition_b_two_apart_slices_preferred(prefs, alpha, epsilon, return_division)
-    else:
-        return False
+    result = condition_b_adjacent_slices_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    result = condition_b_one_apart_slices_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    result = condition_b_two_apart_slices_preferred(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    return InvariantResult(False)
     
 #condition B stuff above
 
-def check_invariant_four_agents(prefs, alpha, epsilon, return_division = False):
-    '''
-    Checks if the invariant is true for the Hollender-Rubinstein algorithm.
-    '''
-    if check_condition_a(prefs, alpha, epsilon) == True:
-        return check_condition_a(prefs, alpha, epsilon, return_division)
-    elif check_condition_b(prefs, alpha, epsilon) == True:
-        return check_condition_b(prefs, alpha, epsilon, return_division)
-    else:
-        return False
+def invariant_case_batches():
+    '''
+    Splits the invariant cases into batches that are checked in parallel, each a list of
+    (rank, case) in checking order. The first batch is condition A and slices two and 
+    three, which gives up at the first missing middle cut so is kept whole, and each 
+    other batch is the rest of condition B for one indifferent agent. The ranks follow
+    the sequential check, so the case that holds with the lowest rank is its result.
+    '''
+    cases = [condition_a_slice_one_preferred, condition_a_slice_two_preferred,
+             condition_a_slice_three_preferred, condition_a_slice_four_preferred,
+             condition_b_slice_one_two_preferred, condition_b_slice_two_three_preferred,
+             condition_b_slice_three_four_preferred, condition_b_slice_one_three_preferred,
+             condition_b_slice_two_four_preferred, condition_b_slice_one_four_preferred]
+    whole_cases = cases[:4] + [condition_b_slice_two_three_preferred]
+    batches = [[(4 * cases.index(case), case) for case in whole_cases]]
+    for i in range(1,4):
+        batches.append([(4 * number + i, partial(case, indifferent_agents = (i,))) 
+                        for number, case in enumerate(cases) if case not in whole_cases])
+    return batches
+
+
+def check_invariant_case_batch(slot, key, state, alpha, epsilon, batch_number):
+    '''
+    Checks a batch of invariant cases on an invariant worker until one holds or one with
+    a lower rank is found to hold by another worker. Returns the rank and result of the
+    case that holds, or None. The preferences are compiled from their state by the 
+    first batch of a solve on each worker and kept with their caches for the next.
+    '''
+    prefs = _invariant_preferences.get(key)
+    if prefs is None:
+        prefs = CompiledPreferences([AgentValuation(*columns) 
+                                     for columns in pickle.loads(state)])
+        _invariant_preferences[key] = prefs
+        if len(_invariant_preferences) > INVARIANT_WORKER_PREFERENCES:
+            _invariant_preferences.popitem(last = False)
+    _invariant_preferences.move_to_end(key)
+    for rank, case in invariant_case_batches()[batch_number]:
+        if rank > _invariant_stop_ranks[slot]:
+            return None
+        result = case(prefs, alpha, epsilon)
+        if result.holds == True:
+            with _invariant_stop_ranks.get_lock():
+                _invariant_stop_ranks[slot] = min(_invariant_stop_ranks[slot], rank)
+            return rank, result
+    return None
+
+
+@timed('invariant')
+def find_invariant_four_agents(prefs, alpha, epsilon, workers = None):
+    '''
+    Checks if the invariant is true for the Hollender-Rubinstein algorithm. Each case is
+    only computed once and the returned result carries the division and info of the
+    case that holds. If invariant workers are given the cases are checked on them.
+    '''
+    if workers is not None:
+        return workers.check(alpha, epsilon)
+    result = check_condition_a(prefs, alpha, epsilon)
+    if result.holds == True:
+        return result
+    return check_condition_b(prefs, alpha, epsilon)
+
+
+@timed('envy_free_check')
+def certify_envy_free(prefs, division, agents_number, epsilon):
+    '''
+    Checks if a division is envy-free by looking for an assignment that gives every
+    agent a slice within epsilon / 12 of their favourite. Takes one batched value query,
+    so it is cheap enough to run at each step of the alpha bisection.
+    '''
+    agent_slice_values = slice_value_matrix(prefs, division, agents_number, epsilon)
+    max_slice_values = np.max(agent_slice_values, axis = 1)
+    envied = ~np.isclose(agent_slice_values, max_slice_values[:, np.newaxis], 
+                         rtol = 0, atol = epsilon / 12)
+    agent_indices, slice_indices = linear_sum_assignment(envied)
+    return np.any(envied[agent_indices, slice_indices]) == False
+
 
-    
 def check_envy_free_four_agent(prefs, division, epsilon):
     '''
     Checks if a division is envy-free for four agents.
     '''
-    agent_slice_values = np.zeros((4,4))
-    for i in range(4):
-        agent_slice_values[i] = slice_values(i, prefs, division, 4, epsilon)
-    for h in range(4):
-        for i in range(4):
-            for j in range(4):
-                for k in range(4):
-                    if (k == j) or (k == i) or (j == i) or (h == i) or (h == j) or (h == k):
-                        continue
-                    if  np.isclose(agent_slice_values[0][h], np.max(agent_slice_values[0]), rtol = 0, atol = epsilon / 12) and \
-                        np.isclose(agent_slice_values[1][i], np.max(agent_slice_values[1]), rtol = 0, atol = epsilon / 12) and \
-                        np.isclose(agent_slice_values[2][j], np.max(agent_slice_values[2]), rtol = 0, atol = epsilon / 12) and \
-                        np.isclose(agent_slice_values[3][k], np.max(agent_slice_values[3]), rtol = 0, atol = epsilon / 12):
-                            return True
-    return False
+    return certify_envy_free(prefs, division, 4, epsilon)
 
 
+@timed('assign_slices')
 def assign_slices(division, prefs, agents_number, epsilon, additive = False):
     '''
     Makes a cost matrix where the cost of an agent being assigned a slice is the difference
@@ -2022,11 +2422,11 @@ def assign_slices(division, prefs, agents_number, epsilon, additive = False):
     than epsilon below the agents favourite slice, the cost is set to 10000 for that agent. 
     This cost matrix is then passed into a cost minimization function that assigns the slices.
     '''
-    agent_slice_values = np.zeros((agents_number, agents_number))
-    for i in range(agents_number):
-        if additive == False:
-            agent_slice_values[i] = slice_values(i, prefs, division, agents_number, epsilon)
-        else:
+    if additive == False:
+        agent_slice_values = slice_value_matrix(prefs, division, agents_number, epsilon)
+    else:
+        agent_slice_values = np.zeros((agents_number, agents_number))
+        for i in range(agents_number):
             agent_slice_values[i] = slice_values_additive(i, prefs, division, epsilon)
 
     max_slice_values = np.max(agent_slice_values, axis = 1)
@@ -2054,96 +2454,154 @@ def raw_division(division, cakeSize, agents_number):
                 "right": right_cut}
     
 
-def branzei_nisan(raw_prefs, cake_size):
+def branzei_nisan(raw_prefs, cake_size, early_exit = False, session = None):
     '''
     This is a version of Branzei Nisan that is written similarly to the Hollender-Rubinstein
-    algorithm. For the version implemented on the site, see branzei_nisan_additive.
+    algorithm. For the version implemented on the site, see branzei_nisan_additive. If 
+    early_exit is True, the alpha bisection stops as soon as the division at the lower
+    bound is certified envy-free. If a solve session is given, the state of agents 
+    unchanged since its last solve is reused.
     '''
-    prefs = one_lipschitz(raw_prefs, cake_size)
+    prefs = compile_preferences(preprocess(raw_prefs, cake_size), session)
     equipartition, alpha_lower_bound = compute_equipartition(prefs, 3, epsilon)
     if check_equipartition_envy_free_three_agents(prefs, alpha_lower_bound, 3,
                                                   epsilon) == True:
         slice_assignments = assign_slices(equipartition, prefs, 3, epsilon)
         raw_envy_free_division = raw_division(equipartition, cake_size, 3)
-        return jsonify({'division': raw_envy_free_division,
-                        'assignment': slice_assignments,
-                        'condition': 0})
+        return {'division': raw_envy_free_division,
+                'assignment': slice_assignments,
+                'condition': 0}
     alpha_upper_bound = 1
     alpha_bounds = Bounds(alpha_lower_bound, alpha_upper_bound)
-    while abs(alpha_bounds.upper - alpha_bounds.lower) > ((epsilon)**4)/12:
-        alpha = alpha_bounds.midpoint()
-        if check_invariant_three_agents(prefs, alpha, epsilon)[0] == True:
-            alpha_bounds.lower = alpha
-        else:
-            alpha_bounds.upper = alpha
-    envy_free_division, slices = division_three_agents(prefs, alpha_bounds.lower, epsilon)
+    certified_division = None
+    with timed_phase('alpha_search'):
+        while abs(alpha_bounds.upper - alpha_bounds.lower) > ((epsilon)**4)/12:
+            alpha = alpha_bounds.midpoint()
+            holds, slices = check_invariant_three_agents(prefs, alpha, epsilon)
+            if holds == True:
+                alpha_bounds.lower = alpha
+                if early_exit == True:
+                    division = slice_division_three_agents(prefs, alpha, slices, epsilon)
+                    if certify_envy_free(prefs, division, 3, epsilon) == True:
+                        certified_division = division
+                        break
+            else:
+                alpha_bounds.upper = alpha
+    if certified_division is not None:
+        envy_free_division = certified_division
+    else:
+        envy_free_division, slices = division_three_agents(prefs, alpha_bounds.lower, 
+                                                           epsilon)
     raw_equipartition = raw_division(equipartition, cake_size, 3)
     slice_assignments = assign_slices(envy_free_division, prefs, 3, epsilon)
     raw_envy_free_division = raw_division(envy_free_division, cake_size, 3)
-    return jsonify({'equipartition': raw_equipartition,
-                    'division': raw_envy_free_division,
-                    'assignment': slice_assignments,
-                    'condition': 1,
-                    'slices': slices})
-
-
-def hollender_rubinstein(raw_prefs, cake_size):
+    return {'equipartition': raw_equipartition,
+            'division': raw_envy_free_division,
+            'assignment': slice_assignments,
+            'condition': 1,
+            'slices': slices}
+
+
+def alpha_progress_event(iteration, start_time, prefs, alpha, alpha_bounds, result, 
+                         cake_size):
+    '''
+    Returns the progress event of a step of the alpha bisection, with the condition 
+    and division of the invariant case that held, if any.
+    '''
+    event = {'event': 'iteration',
+             'iteration': iteration,
+             'elapsed': timer() - start_time,
+             'alpha': alpha,
+             'alpha_lower': alpha_bounds.lower,
+             'alpha_upper': alpha_bounds.upper,
+             'holds': result.holds,
+             'grid_queries': prefs.grid_cache.stats(),
+             'query_counts': current_query_counts()}
+    if result.holds == True:
+        event['division'] = raw_division(result.division, cake_size, 4)
+        event['condition'] = result.info['condition'].to_list()
+        event['slices'] = result.info['slices'].to_list()
+        event['indifferent_agent'] = result.info['indifferent_agent'].to_list()
+    return event
+
+
+def hollender_rubinstein(raw_prefs, cake_size, progress = None, early_exit = False, 
+                         session = None, pool = None):
     '''
     The hollender-rubinstein algorithm for finding an envy-free division for four agents.
-    Returns jsonified values that can be used by the Fair Slice website.
-    '''
-    prefs = one_lipschitz(raw_prefs, cake_size)
+    Returns values that can be jsonified for the Fair Slice website. If progress is 
+    given, it is called with an event dict after the equipartition and each alpha 
+    step. If early_exit is True, the alpha bisection stops as soon as the 
+    division at the lower bound is certified envy-free. If a solve session is given, 
+    the state of agents unchanged since its last solve is reused. If an invariant pool
+    is given and has room, the invariant cases of each alpha step are checked on its 
+    workers, giving the same division. Queries made on the workers are not counted.
+    '''
+    start_time = timer()
+    prefs = compile_preferences(preprocess(raw_prefs, cake_size), session)
     equipartition, alpha_lower_bound = compute_equipartition(prefs, 4, epsilon)
+    if progress is not None:
+        progress({'event': 'equipartition',
+                  'elapsed': timer() - start_time,
+                  'division': raw_division(equipartition, cake_size, 4),
+                  'alpha': alpha_lower_bound,
+                  'grid_queries': prefs.grid_cache.stats(),
+                  'query_counts': current_query_counts()})
     if check_equipartition_envy_free_four_agents(prefs, alpha_lower_bound, 4,
                                                  epsilon) == True:
         slice_assignments = assign_slices(equipartition, prefs, 4, epsilon)
         raw_envy_free_division = raw_division(equipartition, cake_size, 4)
-        return jsonify({'equipartition': raw_envy_free_division,
-                        'division': 0,
-                        'assignment': slice_assignments,
-                        'condition': [0],
-                        'slices': 0,
-                        'indifferent_agent': 0})
+        return {'equipartition': raw_envy_free_division,
+                'division': 0,
+                'assignment': slice_assignments,
+                'condition': [0],
+                'slices': 0,
+                'indifferent_agent': 0}
     alpha_upper_bound = 1
     alpha_bounds = Bounds(alpha_lower_bound, alpha_upper_bound)
-    while abs(alpha_bounds.upper - alpha_bounds.lower) > ((epsilon)**4)/12:
-        alpha = alpha_bounds.midpoint()
-        if check_invariant_four_agents(prefs, alpha, epsilon) == True:
-            alpha_bounds.lower = alpha
-        else:
-            alpha_bounds.upper = alpha
-    envy_free_division, info = check_invariant_four_agents(prefs, alpha_bounds.lower, 
-                                                           epsilon, return_division = True)
-    if check_envy_free_four_agent(prefs, envy_free_division, epsilon) == True:
-        print("True")
-    else:
-        print("False")
+    lower_bound_result = None
+    certified = False
+    iteration = 0
+    workers = None if pool is None else pool.reserve(prefs)
+    try:
+        with timed_phase('alpha_search'):
+            while abs(alpha_bounds.upper - alpha_bounds.lower) > ((epsilon)**4)/12:
+                alpha = alpha_bounds.midpoint()
+                result = find_invariant_four_agents(prefs, alpha, epsilon, workers)
+                if result.holds == True:
+                    alpha_bounds.lower = alpha
+                    lower_bound_result = result
+                    if early_exit == True:
+                        certified = certify_envy_free(prefs, result.division, 4, epsilon)
+                else:
+                    alpha_bounds.upper = alpha
+                iteration += 1
+                if progress is not None:
+                    progress(alpha_progress_event(iteration, start_time, prefs, alpha, 
+                                                  alpha_bounds, result, cake_size))
+                if certified == True:
+                    break
+            if lower_bound_result is None:
+                lower_bound_result = find_invariant_four_agents(prefs, alpha_bounds.lower,
+                                                                epsilon, workers)
+    finally:
+        if workers is not None:
+            workers.release()
+    envy_free_division = lower_bound_result.division
+    info = lower_bound_result.info
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug('Envy-free after %d alpha steps: %s', iteration, 
+                         certified or check_envy_free_four_agent(prefs, envy_free_division, 
+                                                                 epsilon))
     raw_equipartition = raw_division(equipartition, cake_size, 4)
     slice_assignments = assign_slices(envy_free_division, prefs, 4, epsilon)
     raw_envy_free_division = raw_division(envy_free_division, cake_size, 4)
-    return jsonify({'equipartition': raw_equipartition,
-                    'division': raw_envy_free_division,
-                    'assignment': slice_assignments,
-                    'condition': info['condition'].to_list(),
-                    'slices': info['slices'].to_list(),
-                    'indifferent_agent': info['indifferent_agent'].to_list()})
-
-
-def hungriness_additive(prefs, epsilon):
-    '''
-    Modifies the valuation function to be hungry.
-    '''
-    for agents in prefs:
-        hungriness_check = True
-        for segments in agents:
-            if (segments['startValue'] == 0) and (segments['endValue'] == 0):
-                hungriness_check = False
-                break
-        if hungriness_check == False:
-            for segments in agents:
-                segments['startValue'] = (1 - epsilon / 2) * segments['startValue']  + epsilon / 2
-                segments['endValue'] = (1 - epsilon / 2) * segments['endValue']  + epsilon / 2
-    return prefs
+    return {'equipartition': raw_equipartition,
+            'division': raw_envy_free_division,
+            'assignment': slice_assignments,
+            'condition': info['condition'].to_list(),
+            'slices': info['slices'].to_list(),
+            'indifferent_agent': info['indifferent_agent'].to_list()}
 
 
 def value_query_piecewise_additive(agent, prefs, end, epsilon):
@@ -2181,6 +2639,7 @@ def value_query_interpolated_additive(agent, prefs, end, epsilon):
         return value
 
 
+@counted('value_query')
 def value_query_additive(agent, prefs, start, end, epsilon):
     '''
     Leverages additive valuation function to allow subtraction of two value queries for
@@ -2192,58 +2651,99 @@ def value_query_additive(agent, prefs, start, end, epsilon):
     return value
 
 
-def end_cut_query_additive(agent, prefs, start, value, epsilon):
+def piecewise_additive_values(agent, prefs, ends, epsilon):
     '''
-    Finds the end cut given a start cut and final value by branzei nisan's procedure.
+    Vectorised value_query_piecewise_additive for an array of grid points.
     '''
-    end_cut_bounds = Bounds(start, 1)
-    while (end_cut_bounds.upper - end_cut_bounds.lower) > epsilon / 200:
-        end_cut_bounds = end_cut_bounds_update_additive(agent, prefs, start, end_cut_bounds, 
-                                                        value, epsilon)
-    end_cut = end_cut_bounds.midpoint()
-    return end_cut
+    initial_values = np.where(ends > 0, prefs[agent].cumulative_values(ends) - 
+                              prefs[agent].cumulative_value(0), 0)
+    return np.where(initial_values % epsilon == 0, initial_values, 
+                    (initial_values // epsilon) * epsilon + epsilon)
 
 
-def end_cut_bounds_update_additive(agent, prefs, start, end_cut_bounds, 
-                                   value, epsilon):
+def interpolated_additive_values(agents, prefs, ends, epsilon):
     '''
-    Updates the end cut bounds for the binary search.
+    Vectorised value_query_interpolated_additive, returning the values of each of the 
+    agents at each of the ends as a matrix by agent and end.
     '''
-    end_cut = end_cut_bounds.midpoint()
-    queried_value = value_query_additive(agent, prefs, start, end_cut, epsilon)
-    if queried_value <= value:
-        end_cut_bounds.lower  = end_cut
-    if queried_value > value:
-        end_cut_bounds.upper = end_cut
-    return end_cut_bounds
+    prefs = compile_preferences(prefs)
+    ends = np.asarray(ends, dtype = float)
+    checks = ends % epsilon
+    on_grid = np.isclose(checks, 0, rtol = 0, atol = 1e-15) | \
+              np.isclose(checks, epsilon, rtol = 0, atol = 1e-15)
+    interpolation_constants = checks / epsilon
+    ends_left = (ends // epsilon) * epsilon
+    ends_right = ends_left + epsilon
+    values = np.zeros((len(agents), len(ends)))
+    for row, agent in enumerate(agents):
+        values_left = piecewise_additive_values(agent, prefs, ends_left, epsilon)
+        values_right = piecewise_additive_values(agent, prefs, ends_right, epsilon)
+        values[row] = np.where(on_grid, piecewise_additive_values(agent, prefs, ends, 
+                                                                  epsilon),
+                               values_left + (values_right - values_left) * 
+                               interpolation_constants)
+    return values
 
 
-def start_cut_query_additive(agent, prefs, end, value, epsilon):
+def additive_value_grid(agent, prefs, epsilon):
     '''
-    Finds the start cut given a end cut and final value by branzei nisan's procedure.
+    Returns value_query_piecewise_additive at every point of the epsilon grid. 
+    Computed in one vectorised pass the first time it is needed for an agent.
     '''
-    start_cut_bounds = Bounds(0, end)
-    while (start_cut_bounds.upper - start_cut_bounds.lower) > epsilon / 200:
-        start_cut_bounds = start_cut_bounds_update_additive(agent, prefs, end, start_cut_bounds, 
-                                                            value, epsilon)
-    start_cut = start_cut_bounds.midpoint()
-    return start_cut
+    prefs = compile_preferences(prefs)
+    key = (agent, epsilon)
+    if key not in prefs.additive_grids:
+        grid_points = np.arange(int(1 // epsilon) + 2) * epsilon
+        initial_values = prefs[agent].cumulative_values(grid_points)
+        values = np.where(initial_values % epsilon == 0, initial_values,
+                          (initial_values // epsilon) * epsilon + epsilon)
+        prefs.additive_grids[key] = values.tolist()
+    return prefs.additive_grids[key]
 
 
-def start_cut_bounds_update_additive(agent, prefs, end, start_cut_bounds, 
-                            value, epsilon):
+def interpolate_grid_position(grid, index, value, epsilon):
     '''
-    Updates the start cut bounds for the binary search.
+    Finds the position between grid points index - 1 and index at which the linearly
+    interpolated grid values equal the inputted value.
     '''
-    start_cut = start_cut_bounds.midpoint()
-    queried_value = value_query_additive(agent, prefs, start_cut, end, epsilon)
-    if queried_value <= value:
-        start_cut_bounds.upper  = start_cut
-    if queried_value > value:
-        start_cut_bounds.lower = start_cut
-    return start_cut_bounds
+    step = (value - grid[index - 1]) / (grid[index] - grid[index - 1])
+    return (index - 1 + step) * epsilon
 
 
+def end_cut_query_additive(agent, prefs, start, value, epsilon):
+    '''
+    Finds the end cut given a start cut and final value by branzei nisan's procedure.
+    The interpolated value is nondecreasing and linear between grid points, so the 
+    rightmost end cut with at most the inputted value is found directly on the grid.
+    '''
+    grid = additive_value_grid(agent, prefs, epsilon)
+    target = value + value_query_interpolated_additive(agent, prefs, start, epsilon)
+    index = bisect_right(grid, target)
+    if index == 0:
+        return start
+    if index == len(grid):
+        return 1
+    end_cut = interpolate_grid_position(grid, index, target, epsilon)
+    return min(max(end_cut, start), 1)
+
+
+def start_cut_query_additive(agent, prefs, end, value, epsilon):
+    '''
+    Finds the start cut given a end cut and final value by branzei nisan's procedure.
+    The leftmost start cut with at most the inputted value is found directly on the grid.
+    '''
+    grid = additive_value_grid(agent, prefs, epsilon)
+    target = value_query_interpolated_additive(agent, prefs, end, epsilon) - value
+    index = bisect_left(grid, target)
+    if index == 0:
+        return 0
+    if index == len(grid):
+        return end
+    start_cut = interpolate_grid_position(grid, index, target, epsilon)
+    return min(max(start_cut, 0), end)
+
+
+@counted('cut_query')
 def cut_query_additive(agent, prefs, initial_cut, value, epsilon, end_cut = True):
     '''
     Returns a end or start cut position to complete a slice of an inputted value 
@@ -2256,6 +2756,7 @@ def cut_query_additive(agent, prefs, initial_cut, value, epsilon, end_cut = True
     return queried_cut
 
 
+@counted('bisection_cut_query')
 def bisection_cut_query_additive(agent, prefs, start, end, epsilon):
     '''
     Finds a cut that bisects a slice by value given a start and end cut position.
@@ -2266,15 +2767,20 @@ def bisection_cut_query_additive(agent, prefs, start, end, epsilon):
     return mid_cut
 
 
+@timed('equipartition')
 def compute_equipartition_additive(prefs, epsilon):
     '''
     Returns a division that cuts a cake into thirds for the agent with the rightmost right cut.
     '''
     agents = [0,1,2]
     rightmost_mark = 0
+    #The value of the whole cake to every agent is found in one vectorised query.
+    count_queries('value_query', agents)
+    totals = np.diff(interpolated_additive_values(agents, prefs, [0, 1], epsilon), 
+                     axis = 1)[:, 0]
     for i in agents:
-        third_of_total = value_query_additive(i, prefs, 0, 1, epsilon) / 3
-        right_cut = cut_query_additive(i, prefs, 1, third_of_total, epsilon, end_cut = False)
+        right_cut = cut_query_additive(i, prefs, 1, totals[i] / 3, epsilon, 
+                                       end_cut = False)
         if right_cut > rightmost_mark:
             rightmost_mark = right_cut
             chosen_agent = i
@@ -2300,16 +2806,27 @@ def slice_values_additive(agent, prefs, division, epsilon):
                            right_slice_value])
 
 
+def slice_value_matrix_additive(prefs, division, agents, epsilon):
+    '''
+    Returns a three by three matrix of slice values by agent, filling in the rows of 
+    the inputted agents. The rows are the differences of one vectorised query at the
+    cuts, equal to slice_values_additive for each agent.
+    '''
+    agent_slice_values = np.zeros((3,3))
+    count_queries('value_query', np.repeat(agents, 3))
+    cut_values = interpolated_additive_values(agents, prefs, [0, division.left, 
+                                                             division.right, 1], epsilon)
+    agent_slice_values[agents] = np.diff(cut_values, axis = 1)
+    return agent_slice_values
+
+
+@timed('envy_free_check')
 def check_unique_preferences_additive(prefs, division, epsilon):
     '''
     Checks if a division is approximately envy-free.
     '''
     agents = [0,1,2]
-    agents_number = 3
-    slices_number = 3
-    agent_slice_values = np.zeros((agents_number,slices_number))
-    for agent in agents:
-        agent_slice_values[agent] = slice_values_additive(agent, prefs, division, epsilon)                                                                        
+    agent_slice_values = slice_value_matrix_additive(prefs, division, agents, epsilon)
     for i in range(3):
         for j in range(3):
             for k in range(3):
@@ -2325,17 +2842,14 @@ def check_unique_preferences_additive(prefs, division, epsilon):
     return False
 
 
+@timed('preference_check')
 def middle_preferred_check(prefs, division, chosen_agent, epsilon):
     '''
     Checks if the remaining two agents both prefer the middle slice.
     '''
     agents = [0,1,2]
     agents = np.delete(agents, chosen_agent)
-    agents_number = 3
-    slices_number = 3
-    agent_slice_values = np.zeros((agents_number,slices_number))
-    for agent in agents:
-        agent_slice_values[agent] = slice_values_additive(agent, prefs, division, epsilon)
+    agent_slice_values = slice_value_matrix_additive(prefs, division, agents, epsilon)
     if  (np.isclose(agent_slice_values[agents[0]][1], 
                     np.max(agent_slice_values[agents[0]]), rtol = 0, atol = epsilon / 2) and \
          np.isclose(agent_slice_values[agents[1]][1],
@@ -2362,9 +2876,11 @@ def middle_preferred_bounds_update(prefs, cut_bounds, chosen_agent, epsilon):
     return cut_bounds, division                                                                                                                                  
     
 
-def middle_preferred_case(prefs, division, chosen_agent, epsilon):
+@timed('bisection')
+def middle_preferred_case(prefs, division, chosen_agent, epsilon, progress = None):
     '''
-    runs the middle slice preferred procedure of branzei nisan algorithm.
+    runs the middle slice preferred procedure of branzei nisan algorithm. If given, 
+    progress is called with the cut bounds and division after each step.
     '''
     upper_bound = division.right
     half_of_total = value_query_additive(chosen_agent, prefs, 0, 1, epsilon) / 2
@@ -2374,19 +2890,18 @@ def middle_preferred_case(prefs, division, chosen_agent, epsilon):
     while check_unique_preferences_additive(prefs, division, epsilon) == False:
         cut_bounds, division = middle_preferred_bounds_update(prefs, cut_bounds, 
                                                               chosen_agent, epsilon)
+        if progress is not None:
+            progress(cut_bounds, division)
     return division
 
+@timed('preference_check')
 def left_preferred_check(prefs, division, chosen_agent, epsilon):
     '''
     Checks if the remaining two agents both prefer the left slice.
     '''
     agents = [0,1,2]
     agents = np.delete(agents, chosen_agent)
-    agents_number = 3
-    slices_number = 3
-    agent_slice_values = np.zeros((agents_number,slices_number))
-    for agent in agents:
-        agent_slice_values[agent] = slice_values_additive(agent, prefs, division, epsilon)
+    agent_slice_values = slice_value_matrix_additive(prefs, division, agents, epsilon)
     if  (np.isclose(agent_slice_values[agents[0]][0], 
                     np.max(agent_slice_values[agents[0]]), rtol = 0, atol = epsilon / 2) and \
          np.isclose(agent_slice_values[agents[1]][0],
@@ -2411,550 +2926,601 @@ def left_preferred_bounds_update(prefs, cut_bounds, chosen_agent, epsilon):
     return cut_bounds, division                                                                                                                                          
     
 
-def left_preferred_case(prefs, division, chosen_agent, epsilon):
+@timed('bisection')
+def left_preferred_case(prefs, division, chosen_agent, epsilon, progress = None):
     '''
-    runs the middle slice preferred procedure of branzei nisan algorithm.
+    runs the middle slice preferred procedure of branzei nisan algorithm. If given, 
+    progress is called with the cut bounds and division after each step.
     '''
     lower_bound = 0
     upper_bound = division.left
     cut_bounds = Bounds(lower_bound, upper_bound)
     while check_unique_preferences_additive(prefs, division, epsilon) == False:
-        cut_bounds, division = left_preferred_bounds_update(prefs, cut_bounds, chosen_agent, epsilon)
+        cut_bounds, division = left_preferred_bounds_update(prefs, cut_bounds, chosen_agent, 
+                                                            epsilon)
+        if progress is not None:
+            progress(cut_bounds, division)
     return division
 
 
-def branzei_nisan_additive(raw_prefs, cakeSize):
+def branzei_nisan_additive(raw_prefs, cakeSize, progress = None, session = None):
     '''
-    Runs the branzei nisan algorithm for envy-free division between three agents.
+    Runs the branzei nisan algorithm for envy-free division between three agents. If 
+    progress is given, it is called with an event dict after the equipartition and each
+    cut update.
+    If a solve session is given, the value grids of agents unchanged since its last 
+    solve are reused.
     '''
-    non_hungry_prefs = one_lipschitz(raw_prefs, cakeSize)
-    prefs = hungriness_additive(non_hungry_prefs, epsilon)
+    start_time = timer()
+    prefs = compile_preferences(preprocess(raw_prefs, cakeSize, hungry_epsilon = epsilon),
+                                session)
     equipartition, chosen_agent = compute_equipartition_additive(prefs, epsilon)
+    if progress is not None:
+        progress({'event': 'equipartition',
+                  'elapsed': timer() - start_time,
+                  'division': raw_division(equipartition, cakeSize, 3),
+                  'chosen_agent': chosen_agent,
+                  'query_counts': current_query_counts()})
+        iterations = itertools.count(1)
+        case_progress = lambda cut_bounds, division: progress(
+            {'event': 'iteration',
+             'iteration': next(iterations),
+             'elapsed': timer() - start_time,
+             'cut_lower': cut_bounds.lower * cakeSize,
+             'cut_upper': cut_bounds.upper * cakeSize,
+             'division': raw_division(division, cakeSize, 3),
+             'query_counts': current_query_counts()})
+    else:
+        case_progress = None
     if check_unique_preferences_additive(prefs, equipartition, epsilon) == True:
         slice_assignments = assign_slices(equipartition, prefs, 3, epsilon, additive = True)
         raw_envy_free_division = raw_division(equipartition, cakeSize, 3)
-        return jsonify({'equipartition': raw_envy_free_division,
-                        'assignment': slice_assignments,
-                        'chosen_agent': chosen_agent,
-                        'condition': 0})
+        return {'equipartition': raw_envy_free_division,
+                'assignment': slice_assignments,
+                'chosen_agent': chosen_agent,
+                'condition': 0}
     if middle_preferred_check(prefs, equipartition, chosen_agent, epsilon) == True:
-        envy_free_division = middle_preferred_case(prefs, equipartition, chosen_agent, epsilon)
+        envy_free_division = middle_preferred_case(prefs, equipartition, chosen_agent, 
+                                                   epsilon, case_progress)
         specifics = 0
     else:
-        envy_free_division = left_preferred_case(prefs, equipartition, chosen_agent, epsilon)
+        envy_free_division = left_preferred_case(prefs, equipartition, chosen_agent, 
+                                                 epsilon, case_progress)
         specifics = 1
     raw_equipartition = raw_division(equipartition, cakeSize, 3)
     slice_assignments = assign_slices(envy_free_division, prefs, 3, epsilon, additive = True)
     raw_envy_free_division = raw_division(envy_free_division, cakeSize, 3)
-    return jsonify({'equipartition': raw_equipartition,
-                    'division': raw_envy_free_division,
-                    'assignment': slice_assignments,
-                    'chosen_agent': chosen_agent,
-                    'condition': 1,
-                    'specifics': specifics})
+    return {'equipartition': raw_equipartition,
+            'division': raw_envy_free_division,
+            'assignment': slice_assignments,
+            'chosen_agent': chosen_agent,
+            'condition': 1,
+            'specifics': specifics}
 
 
 #piecewise-constant algorithm
 
-def find_segments_intervals(prefs):
-    '''
-    Finds the list of start and endpoints for all agents preferences excluding duplicates.
-    '''
-    breakpoints = set()
-    for agents in prefs:
-        for segments in agents:
-            assert (segments['startValue'] == segments['endValue']), \
-                'Valuations must be piecewise-constant for this algorithm.'
-            if segments['startValue'] > 0:
-                breakpoints.add(segments['start'])
-                breakpoints.add(segments['end'])
-
-    # Convert breakpoints to a sorted list
-    sorted_breakpoints = sorted(breakpoints)
-    segment_intervals=[]
-    for i in range(1, len(sorted_breakpoints)):
-        left = sorted_breakpoints[i-1]
-        right = sorted_breakpoints[i]
-        segment_intervals.append({
-                'start': left,
-                'end': right
-            })
-    return segment_intervals
-
-
-def remove_zeros_from_segments(segmented_prefs, agents_number):
-    '''
-    Removes the segments that all agents value at zero.
-    '''
-    amount_of_segments = len(segmented_prefs[0])
-    segments_to_remove = []
-    for i in range(amount_of_segments):
-        zero_values = 0
-        for j in range(agents_number):
-            if segmented_prefs[j][i]['value'] == 0:
-                zero_values += 1
-                if zero_values == agents_number:
-                    segments_to_remove.append(i)
-    sorted_segments_to_remove = sorted(segments_to_remove, reverse=True)
-    for i in sorted_segments_to_remove:
-        for j in range(agents_number):
-            del segmented_prefs[j][i]
-    return segmented_prefs
-
-
-
+def segment_refinement(prefs):
+    '''
+    Returns the common refinement of all agents' piecewise-constant preferences as 
+    arrays of interval starts and ends, matrices of values and areas by agent and 
+    interval, and a mask of the intervals every agent values at zero. The intervals run
+    between the ends of the positively valued segments, so each agent's value on an 
+    interval is read off the segment holding its midpoint with one sorted search.
+    '''
+    if not isinstance(prefs, ColumnarPreferences):
+        prefs = ColumnarPreferences.from_segments(prefs)
+    breakpoints = []
+    for starts, ends, start_values, end_values in prefs.agents:
+        assert np.array_equal(start_values, end_values), \
+            'Valuations must be piecewise-constant for this algorithm.'
+        valued = start_values > 0
+        breakpoints.extend([starts[valued], ends[valued]])
+    breakpoints = np.unique(np.concatenate(breakpoints))
+    interval_starts = breakpoints[:-1]
+    interval_ends = breakpoints[1:]
+    midpoints = (interval_starts + interval_ends) / 2
+    values = np.zeros((len(prefs), len(midpoints)))
+    for agent, (starts, ends, start_values, _) in enumerate(prefs.agents):
+        order = np.argsort(starts, kind = 'stable')
+        index = np.searchsorted(starts[order], midpoints, side = 'right') - 1
+        holding = order[np.maximum(index, 0)]
+        covered = (index >= 0) & (ends[holding] > midpoints)
+        values[agent] = np.where(covered, start_values[holding], 0)
+    areas = (interval_ends - interval_starts) * values
+    zero_mask = np.all(values == 0, axis = 0)
+    return interval_starts, interval_ends, values, areas, zero_mask
+
+
+@timed('find_segments')
 def find_segments(prefs, agents_number):
     '''
     Finds the piecewise-constant segments that will be investigated by the algorithm for
-    cut position.    
+    cut position, leaving out those that all agents value at zero.
+    '''
+    starts, ends, values, areas, zero_mask = segment_refinement(prefs)
+    kept = ~zero_mask
+    starts = starts[kept].tolist()
+    ends = ends[kept].tolist()
+    return [[{'start': start, 'end': end, 'value': value, 'area': area}
+             for start, end, value, area in zip(starts, ends, agent_values, agent_areas)]
+            for agent_values, agent_areas in zip(values[:, kept].tolist(), 
+                                                 areas[:, kept].tolist())]
+
+
+def scale_segments(segmented_prefs, cake_size):
+    '''
+    Returns the segments moved to the interval [0,1]. Gives the same segments as 
+    find_segments would on preferences with scaled bounds.
+    '''
+    scaled_prefs = []
+    for agent_segments in segmented_prefs:
+        scaled_agent_segments = []
+        for segment in agent_segments:
+            start = segment['start'] / cake_size
+            end = segment['end'] / cake_size
+            scaled_agent_segments.append({'start': start,
+                                          'end': end,
+                                          'value': segment['value'],
+                                          'area': (end - start) * segment['value']})
+        scaled_prefs.append(scaled_agent_segments)
+    return scaled_prefs
+
+def slice_value_coefficients(segments, agents, cuts):
+    '''
+    Returns the slice values of each agent as linear functions of the cut positions, 
+    given as coefficients by agent, slice and cut and constants by agent and slice. 
+    A single agent gives a matrix and a vector.
+    '''
+    segments = compile_segments(segments)
+    cuts = np.asarray(cuts)
+    cuts_number = len(cuts)
+    #The value from the start of the cake to cut k is offsets[k] + rates[k] * cut k.
+    rates = segments.values[agents][..., cuts]
+    offsets = segments.cumulative_areas[agents][..., cuts] - rates * segments.starts[cuts]
+    coefficients = np.zeros(rates.shape[:-1] + (cuts_number + 1, cuts_number))
+    coefficients[..., np.arange(cuts_number), np.arange(cuts_number)] = rates
+    coefficients[..., np.arange(1, cuts_number + 1), np.arange(cuts_number)] = -rates
+    totals = segments.cumulative_areas[agents][..., -1:]
+    constants = np.diff(np.concatenate([np.zeros_like(totals), offsets, totals], 
+                                       axis = -1), axis = -1)
+    return coefficients, constants
+
+
+def envy_free_linear_program(segments, agents, cuts):
+    '''
+    Returns the matrix, vector and cut bounds of the linear constraints A x <= b for 
+    the cut positions x to give an envy-free division when slice i goes to agents[i].
+    '''
+    segments = compile_segments(segments)
+    cuts_number = len(cuts)
+    slices_number = cuts_number + 1
+    coefficients, constants = slice_value_coefficients(segments, list(agents), cuts)
+    own_slices = np.arange(slices_number)
+    #Every other slice is valued at most as much as the agent's own slice.
+    other_slices = ~np.eye(slices_number, dtype = bool)
+    envy_matrix = coefficients - coefficients[own_slices, own_slices][:, np.newaxis]
+    envy_vector = constants[own_slices, own_slices][:, np.newaxis] - constants
+    #Each cut is before the next one.
+    ordering = np.zeros((cuts_number - 1, cuts_number))
+    ordering[np.arange(cuts_number - 1), np.arange(cuts_number - 1)] = 1
+    ordering[np.arange(cuts_number - 1), np.arange(1, cuts_number)] = -1
+    matrix = np.concatenate([envy_matrix[other_slices], ordering])
+    vector = np.concatenate([envy_vector[other_slices], np.zeros(cuts_number - 1)])
+    cut_bounds = list(zip(segments.starts[cuts].tolist(), segments.ends[cuts].tolist()))
+    return matrix, vector, cut_bounds
+
+
+def find_division_least_squares(segments, agents, cuts):
     '''
-    segments_intervals = find_segments_intervals(prefs)
-    segmented_prefs = [[] for _ in range(agents_number)]
-    for i in range(agents_number):
-        for intervals in segments_intervals:
-            for segments in prefs[i]:
-                if (((segments['start'] >= intervals['start']) and (segments['start'] < intervals['end'])) or \
-                    ((segments['end'] > intervals['start']) and (segments['end'] <= intervals['end'])) or \
-                    ((segments['start'] <= intervals['start']) and (segments['end'] >= intervals['end']))):
-                    segmented_prefs[i].append({'start': intervals['start'],
-                                               'end': intervals['end'],
-                                               'value': segments['startValue'],
-                                               'area': (intervals['end'] - intervals['start']) * segments['startValue']})
-                    break
-    segmented_prefs_without_zeros = remove_zeros_from_segments(segmented_prefs, agents_number)
-    return segmented_prefs_without_zeros
-
-#For the slice value functions below, the checks that the cut positions are valid 
-#are commented out as they sometimes conflict with the solver.
-
-def first_slice_value(x, segments, agent, cut):
-    '''
-    Returns the function of the first slice value dependent on x, the cut position 
-    minus the investigated segment's startpoint.
-    '''
-    first_agent_constant_value = 0
-    cut_range = segments[agent][cut]['end'] - segments[agent][cut]['start']
-    for i in range(cut):
-        first_agent_constant_value += segments[agent][i]['area']
-    first_agent_variable_value = segments[agent][cut]['value']
-    # if ((0 <= x) and (x <= cut_range)):
-    #     value = first_agent_constant_value + x * first_agent_variable_value 
-    #     return value 
-    # else:
-    #     return "Input out of bounds"
-    value = first_agent_constant_value + x * first_agent_variable_value 
-    return value 
-    
-
-def middle_slice_value(x, y, segments, agent, cut_one, cut_two):
-    '''
-    Returns the function of the middle slice (second or third) value dependent on x and y, 
-    the cut positions minus the investigated segments' startpoints.
-    '''
-    cut_one_range = segments[agent][cut_one]['end'] - segments[agent][cut_one]['start']
-    cut_two_range = segments[agent][cut_two]['end'] - segments[agent][cut_two]['start']
-    middle_agent_constant_value = 0
-    for i in range(cut_one+1, cut_two):
-        middle_agent_constant_value += segments[agent][i]['area']
-    middle_agent_variable_value_component_one = segments[agent][cut_one]['value']
-    middle_agent_variable_value_component_two = segments[agent][cut_two]['value']
-    #assert (((0 <= x) and (x <= cut_one_range)) and ((0 <= y) and (y <= cut_two_range))), \
-    #    "cut out of range"
-    if cut_one != cut_two:
-        value = middle_agent_constant_value + (cut_one_range - x) * middle_agent_variable_value_component_one + \
-                y * middle_agent_variable_value_component_two
+    Runs the least squares solver to check if the investigated segments can contain
+    the necessary cuts for an envy-free division. The constraints are those of the 
+    linear program, so they are one matrix product and their Jacobian is the matrix.
+    '''
+    matrix, vector, cut_bounds = envy_free_linear_program(segments, agents, cuts)
+    constraints = [{'type': 'ineq', 
+                    'fun': lambda x: vector - matrix @ x, 
+                    'jac': lambda x: -matrix}]
+    initial_guess = [lower_bound for lower_bound, _ in cut_bounds]
+    result = minimize(lambda x: 0, initial_guess, jac = lambda x: np.zeros(len(x)), 
+                      constraints = constraints, bounds = cut_bounds, method = 'SLSQP')
+    if result.success:
+        return {'envy_free_check':True, 'exact_cuts': result.x}
     else:
-        value = middle_agent_constant_value + (y - x) * middle_agent_variable_value_component_one
-    return value
+        return {'envy_free_check':False, 'exact_cuts': None}
 
 
-def last_slice_value(y, segments, agent, cut):
+def find_division_linear_program(segments, agents, cuts):
     '''
-    Returns the function of the last slice value dependent on y, the cut position 
-    minus the investigated segment's startpoint.
+    Solves the linear program to check if the investigated segments can contain
+    the necessary cuts for an envy-free division. An infeasible result is exact rather 
+    than a failure of the solver to converge.
     '''
-    last_agent_constant_value = 0
-    cut_range = segments[agent][cut]['end'] - segments[agent][cut]['start']
-    amount_of_segments = len(segments[agent])
-    for i in range(cut+1, amount_of_segments):
-        last_agent_constant_value += segments[agent][i]['area']
-    last_agent_variable_value = segments[agent][cut]['value']
-    # if ((0 <= y) and (y <= cut_range)):
-    #     value =  last_agent_constant_value + (cut_range - y) * last_agent_variable_value
-    #     return value
-    # else:
-    #     return "Input out of bounds"
-    value =  last_agent_constant_value + (cut_range - y) * last_agent_variable_value
-    return value
-    
+    matrix, vector, cut_bounds = envy_free_linear_program(segments, agents, cuts)
+    objective = np.zeros(len(cuts))
+    result = linprog(objective, A_ub = matrix, b_ub = vector, bounds = cut_bounds, 
+                     method = 'highs')
+    if result.status == 0:
+        return {'envy_free_check':True, 'exact_cuts': result.x}
+    else:
+        return {'envy_free_check':False, 'exact_cuts': None}
 
-def constraints_three_agents(segments, agents, cuts, params):
-    '''
-    The constraints for the solver to find an envy-free division for three agents. 
-    Checks that one section is valued over the other for all agents and that the left cut is
-    before the right cut. 
-    '''
-    def constraint1(vars, params):
-        cut_one, cut_two = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        segments = params[2]
-        agents = params[3]
-        cuts = params[4]
-        slice_one_first_agent_value = first_slice_value(x, segments, agents[0], cuts[0])
-        slice_two_first_agent_value = middle_slice_value(x, y, segments, agents[0], cuts[0], cuts[1])
-        return slice_one_first_agent_value - slice_two_first_agent_value
-
-    def constraint2(vars, params):
-        cut_one, cut_two = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        segments = params[2]
-        agents = params[3]
-        cuts = params[4]
-        slice_one_first_agent_value = first_slice_value(x, segments, agents[0], cuts[0])
-        slice_three_first_agent_value = last_slice_value(y, segments, agents[0], cuts[1])
-        return slice_one_first_agent_value - slice_three_first_agent_value
-
-    def constraint3(vars, params):
-        cut_one, cut_two = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        segments = params[2]
-        agents = params[3]
-        cuts = params[4]
-        slice_two_second_agent_value = middle_slice_value(x, y, segments, agents[1], cuts[0], cuts[1])
-        slice_one_second_agent_value = first_slice_value(x, segments, agents[1], cuts[0])
-        return slice_two_second_agent_value - slice_one_second_agent_value
-
-    def constraint4(vars, params):
-        cut_one, cut_two = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        segments = params[2]
-        agents = params[3]
-        cuts = params[4]
-        slice_two_second_agent_value = middle_slice_value(x, y, segments, agents[1], cuts[0], cuts[1])
-        slice_three_second_agent_value = last_slice_value(y, segments, agents[1], cuts[1])
-        return slice_two_second_agent_value - slice_three_second_agent_value
-
-    def constraint5(vars, params):
-        cut_one, cut_two = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        segments = params[2]
-        agents = params[3]
-
-        cuts = params[4]
-        slice_three_third_agent_value = last_slice_value(y, segments, agents[2], cuts[1])
-        slice_one_third_agent_value = first_slice_value(x, segments, agents[2], cuts[0])
-        return slice_three_third_agent_value - slice_one_third_agent_value
-
-    def constraint6(vars, params):
-        cut_one, cut_two = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        segments = params[2]
-        agents = params[3]
-        cuts = params[4]
-        slice_three_third_agent_value = last_slice_value(y, segments, agents[2], cuts[1])
-        slice_two_third_agent_value = middle_slice_value(x, y, segments, agents[2], cuts[0], cuts[1])
-        return slice_three_third_agent_value - slice_two_third_agent_value
-
-    def constraint7(vars, params):
-        cut_one, cut_two = vars
-        return cut_two - cut_one
-
-    cons = [{'type': 'ineq', 'fun': constraint1, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint2, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint3, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint4, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint5, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint6, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint7, 'args': (params,)}]
-
-    return cons
-
-
-def constraints_four_agents(segments, agents, cuts, params):
-    '''
-    The constraints for the solver to find an envy-free division for four agents. 
-    Checks that one section is valued over the other for all agents and that the left cut is
-    before the middle cut is before the right cut. 
-    '''
-    def constraint1(vars, params):
-        cut_one, cut_two, cut_three = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_one_first_agent_value = first_slice_value(x, segments, agents[0], cuts[0])
-        slice_two_first_agent_value = middle_slice_value(x, y, segments, agents[0], cuts[0], cuts[1])
-        return slice_one_first_agent_value - slice_two_first_agent_value
-            
 
-    def constraint2(vars, params):
-        cut_one, cut_two, cut_three = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        z = cut_three - params[2]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_one_first_agent_value = first_slice_value(x, segments, agents[0], cuts[0])
-        slice_three_first_agent_value = middle_slice_value(y, z, segments, agents[0], cuts[1], cuts[2])
-        return slice_one_first_agent_value - slice_three_first_agent_value
-
-    def constraint3(vars, params):
-        cut_one, cut_two, cut_three = vars
-        x = cut_one - params[0]
-        z = cut_three - params[2]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_one_first_agent_value = first_slice_value(x, segments, agents[0], cuts[0])
-        slice_four_first_agent_value = last_slice_value(z, segments, agents[0], cuts[2])
-        return slice_one_first_agent_value - slice_four_first_agent_value
-
-    def constraint4(vars, params):
-        cut_one, cut_two, cut_three = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_two_second_agent_value =  middle_slice_value(x, y, segments, agents[1], cuts[0], cuts[1])
-        slice_one_second_agent_value = first_slice_value(x, segments, agents[1], cuts[0])
-        return slice_two_second_agent_value - slice_one_second_agent_value
-
-    def constraint5(vars, params):
-        cut_one, cut_two, cut_three = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        z = cut_three - params[2]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_two_second_agent_value =  middle_slice_value(x, y, segments, agents[1], cuts[0], cuts[1])
-        slice_three_second_agent_value = middle_slice_value(y, z, segments, agents[1], cuts[1], cuts[2])
-        return slice_two_second_agent_value - slice_three_second_agent_value
-
-    def constraint6(vars, params):
-        cut_one, cut_two, cut_three = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        z = cut_three - params[2]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_two_second_agent_value =  middle_slice_value(x, y, segments, agents[1], cuts[0], cuts[1])
-        slice_four_second_agent_value = last_slice_value(z, segments, agents[1], cuts[2])
-        return slice_two_second_agent_value - slice_four_second_agent_value
-
-    def constraint7(vars, params):
-        cut_one, cut_two, cut_three = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        z = cut_three - params[2]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_three_third_agent_value = middle_slice_value(y, z, segments, agents[2], cuts[1], cuts[2])
-        slice_one_third_agent_value = first_slice_value(x, segments, agents[2], cuts[0])
-        return slice_three_third_agent_value - slice_one_third_agent_value
-
-    def constraint8(vars, params):
-        cut_one, cut_two, cut_three = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        z = cut_three - params[2]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_three_third_agent_value = middle_slice_value(y, z, segments, agents[2], cuts[1], cuts[2])
-        slice_two_third_agent_value = middle_slice_value(x, y, segments, agents[2], cuts[0], cuts[1])
-        return slice_three_third_agent_value - slice_two_third_agent_value
-
-    def constraint9(vars, params):
-        cut_one, cut_two, cut_three = vars
-        y = cut_two - params[1]
-        z = cut_three - params[2]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_three_third_agent_value = middle_slice_value(y, z, segments, agents[2], cuts[1], cuts[2])
-        slice_four_third_agent_value = last_slice_value(z, segments, agents[2], cuts[2])
-        return slice_three_third_agent_value - slice_four_third_agent_value
-
-    def constraint10(vars, params):
-        cut_one, cut_two, cut_three = vars
-        x = cut_one - params[0]
-        z = cut_three - params[2]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_four_fourth_agent_value = last_slice_value(z, segments, agents[3], cuts[2])
-        slice_one_fourth_agent_value = first_slice_value(x, segments, agents[3], cuts[0])
-        return slice_four_fourth_agent_value - slice_one_fourth_agent_value
-
-    def constraint11(vars, params):
-        cut_one, cut_two, cut_three = vars
-        x = cut_one - params[0]
-        y = cut_two - params[1]
-        z = cut_three - params[2]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_four_fourth_agent_value = last_slice_value(z, segments, agents[3], cuts[2])
-        slice_two_fourth_agent_value = middle_slice_value(x, y, segments, agents[3], cuts[0], cuts[1])
-        return slice_four_fourth_agent_value - slice_two_fourth_agent_value
-
-    def constraint12(vars, params):
-        cut_one, cut_two, cut_three = vars
-        y = cut_two - params[1]
-        z = cut_three - params[2]
-        segments = params[3]
-        agents = params[4]
-        cuts = params[5]
-        slice_four_fourth_agent_value = last_slice_value(z, segments, agents[3], cuts[2])
-        slice_three_fourth_agent_value = middle_slice_value(y, z, segments, agents[3], cuts[1], cuts[2])
-        return slice_four_fourth_agent_value - slice_three_fourth_agent_value
-
-    def constraint13(vars, params):
-        cut_one, cut_two, cut_three = vars
-        return cut_two - cut_one
-
-    def constraint14(vars, params):
-        cut_one, cut_two, cut_three = vars
-        return cut_three - cut_one
-
-    def constraint15(vars, params):
-        cut_one, cut_two, cut_three = vars
-        return cut_three - cut_two
-
-    cons = [{'type': 'ineq', 'fun': constraint1, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint2, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint3, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint4, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint5, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint6, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint7, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint8, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint9, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint10, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint11, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint12, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint13, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint14, 'args': (params,)},
-            {'type': 'ineq', 'fun': constraint15, 'args': (params,)}]
-
-    return cons
-
-
-def find_division_three_agents(segments, agents, cuts):
+def envy_free_mixed_integer_program(segments, agents_number):
+    '''
+    Returns the constraints, integrality and variable bounds of a mixed-integer program 
+    whose solutions are envy-free divisions. The variables are the cut positions, each 
+    cut position split by segment, binaries for the segment each cut is in and binaries
+    for the slice each agent gets. An agent's value up to a cut is then linear in the 
+    variables, and the envy-free constraints only bind for the slice the agent gets.
+    '''
+    segments = compile_segments(segments)
+    cuts_number = agents_number - 1
+    starts = segments.starts
+    ends = segments.ends
+    segments_number = len(starts)
+    #Indices of the variables of each block.
+    cut_positions = np.arange(cuts_number)
+    split_positions = cuts_number + np.arange(cuts_number * segments_number).reshape(
+        cuts_number, segments_number)
+    cut_segments = split_positions + cuts_number * segments_number
+    assignments = cuts_number * (2 * segments_number + 1) + np.arange(
+        agents_number * agents_number).reshape(agents_number, agents_number)
+    variables_number = assignments[-1, -1] + 1
+    rows = []
+    lower = []
+    upper = []
+
+    def add_row(coefficients, lower_bound, upper_bound):
+        row = np.zeros(variables_number)
+        for indices, values in coefficients:
+            row[indices] += values
+        rows.append(row)
+        lower.append(lower_bound)
+        upper.append(upper_bound)
+
+    for k in range(cuts_number):
+        #Each cut is in exactly one segment and equals its split position in it.
+        add_row([(cut_positions[k], 1), (split_positions[k], -1)], 0, 0)
+        add_row([(cut_segments[k], 1)], 1, 1)
+        for j in range(segments_number):
+            add_row([(split_positions[k, j], 1), (cut_segments[k, j], -starts[j])], 
+                    0, np.inf)
+            add_row([(split_positions[k, j], 1), (cut_segments[k, j], -ends[j])], 
+                    -np.inf, 0)
+        if k < cuts_number - 1:
+            add_row([(cut_positions[k], 1), (cut_positions[k + 1], -1)], -np.inf, 0)
+            add_row([(cut_segments[k], np.arange(segments_number)), 
+                     (cut_segments[k + 1], -np.arange(segments_number))], -np.inf, 0)
+    for i in range(agents_number):
+        add_row([(assignments[i], 1)], 1, 1)
+        add_row([(assignments[:, i], 1)], 1, 1)
+    for i in range(agents_number):
+        values = segments.values[i]
+        cumulative_areas = segments.cumulative_areas[i]
+        total = cumulative_areas[-1]
+        offsets = cumulative_areas[:-1] - values * starts
+        #The value up to each end of each slice as coefficients and a constant.
+        cut_values = [([], 0)]
+        cut_values += [([(cut_segments[k], offsets), (split_positions[k], values)], 0) 
+                       for k in range(cuts_number)]
+        cut_values += [([], total)]
+        for own in range(agents_number):
+            #Implied by the envy-free constraints, but tightens the relaxation.
+            add_row(cut_values[own + 1][0] + 
+                    [(indices, -values) for indices, values in cut_values[own][0]] +
+                    [(assignments[i, own], -total)], 
+                    total / agents_number - total - cut_values[own + 1][1] + 
+                    cut_values[own][1], np.inf)
+            for other in range(agents_number):
+                if other == own:
+                    continue
+                #If agent i gets slice own, slice other is worth at most as much to them.
+                coefficients = cut_values[other + 1][0] + cut_values[own][0] + \
+                    [(indices, -values) for indices, values in 
+                     cut_values[other][0] + cut_values[own + 1][0]] + \
+                    [(assignments[i, own], total)]
+                constant = cut_values[other + 1][1] - cut_values[other][1] - \
+                    cut_values[own + 1][1] + cut_values[own][1]
+                add_row(coefficients, -np.inf, total - constant)
+    constraints = LinearConstraint(np.array(rows), lower, upper)
+    integrality = np.zeros(variables_number)
+    integrality[cut_segments.ravel()] = 1
+    integrality[assignments.ravel()] = 1
+    lower_bounds = np.zeros(variables_number)
+    upper_bounds = np.ones(variables_number)
+    upper_bounds[cut_positions] = ends[-1]
+    upper_bounds[split_positions.ravel()] = ends[-1]
+    return (constraints, integrality, VariableBounds(lower_bounds, upper_bounds), 
+            cut_segments, assignments)
+
+
+def equal_share_cuts(segments, agents_number):
+    '''
+    Returns the cuts that divide the cake into equal shares of the agents' average 
+    valuation, with each agent's share of the cake up to each segment boundary and the
+    boundaries.
+    '''
+    segments = compile_segments(segments)
+    cumulative_areas = segments.cumulative_areas
+    totals = cumulative_areas[:, -1:]
+    shares = np.divide(cumulative_areas, totals, out = np.zeros_like(cumulative_areas),
+                       where = totals > 0)
+    boundaries = np.append(segments.starts, segments.ends[-1])
+    equal_cuts = np.interp(np.arange(1, agents_number) / agents_number, 
+                           shares.mean(axis = 0), boundaries)
+    return equal_cuts, shares, boundaries
+
+
+def guiding_objective(segments, agents_number, cut_segments, assignments, 
+                      variables_number):
+    '''
+    Returns an objective that steers the mixed-integer program towards the division 
+    that cuts the cake into equal shares of the agents' average valuation. Each cut 
+    segment costs its distance from that division's cut and each assignment costs the 
+    agent's envy there, relative to their value of the whole cake.
+    '''
+    equal_cuts, shares, boundaries = equal_share_cuts(segments, agents_number)
+    objective = np.zeros(variables_number)
+    for k, equal_cut in enumerate(equal_cuts):
+        objective[cut_segments[k]] = np.maximum(np.maximum(boundaries[:-1] - equal_cut, 
+                                                           equal_cut - boundaries[1:]), 0)
+    cut_shares = np.array([np.interp(np.concatenate([[0], equal_cuts, [boundaries[-1]]]),
+                                     boundaries, agent_shares) for agent_shares in shares])
+    slice_shares = np.diff(cut_shares, axis = 1)
+    objective[assignments] += slice_shares.max(axis = 1, keepdims = True) - slice_shares
+    return objective
+
+
+@timed('feasibility')
+def find_division_mixed_integer_program(segments, agents_number):
+    '''
+    Solves the mixed-integer program for the assignment and cut segments at once. The 
+    cuts are then found exactly by the linear program for that assignment and those 
+    cut segments, as HiGHS only meets the constraints to within its tolerances. 
+    Returns False if the program is infeasible or the linear program rejects its 
+    solution, so only verified cuts are returned.
+    '''
+    constraints, integrality, bounds, cut_segments, assignments = \
+        envy_free_mixed_integer_program(segments, agents_number)
+    objective = guiding_objective(segments, agents_number, cut_segments, assignments, 
+                                  len(integrality))
+    #Every feasible solution is envy-free, so the objective only orders the search 
+    #and the first solution found is good enough.
+    result = milp(objective, constraints = constraints, integrality = integrality, 
+                  bounds = bounds, options = {'mip_rel_gap': 1})
+    if result.status != 0:
+        return False
+    cuts = [int(np.argmax(result.x[indices])) for indices in cut_segments]
+    agents = tuple(int(np.argmax(result.x[assignments[:, slice_number]])) 
+                   for slice_number in range(agents_number))
+    info = find_division_linear_program(segments, agents, cuts)
+    if info['envy_free_check'] == True:
+        return cuts, info['exact_cuts'], agents
+    return False
+
+
+@timed('feasibility')
+def find_division(segments, agents, cuts, agents_number, method = 'linprog'):
     '''
-    Runs the least squares solver to check if the investigated segments can contain
-    the necessary cuts for an envy-free division for three agents.
+    Runs the solver for the investigated segments. The linear program is used by 
+    default and 'slsqp' runs the least squares solver instead.
     '''
-    cut_one_lower_bound = segments[0][cuts[0]]['start']
-    cut_one_upper_bound = segments[0][cuts[0]]['end']
-    cut_two_lower_bound = segments[0][cuts[1]]['start']
-    cut_two_upper_bound = segments[0][cuts[1]]['end']
+    if method == 'linprog':
+        return find_division_linear_program(segments, agents, cuts)
+    return find_division_least_squares(segments, agents, cuts)
 
-    params = [cut_one_lower_bound, cut_two_lower_bound, segments, agents, cuts]
-    cons = constraints_three_agents(segments, agents, cuts, params)
-    initial_guess = [cut_one_lower_bound, cut_two_lower_bound]
-    cut_bounds = [(cut_one_lower_bound, cut_one_upper_bound), (cut_two_lower_bound, cut_two_upper_bound)]
 
-    def objective(vars, *args):
-        return 0
+def compile_segments(segments):
+    '''
+    Compiles the segments found by find_segments into arrays, so that the constraints
+    of each investigated permutation and cut segments are built without walking the 
+    segments. Already compiled segments are returned unchanged.
+    '''
+    if isinstance(segments, CompiledSegments):
+        return segments
+    return CompiledSegments(segments)
 
-    result = minimize(objective, initial_guess, args=(params,), constraints=cons, bounds= cut_bounds)
 
-    if result.success:
-        return {'envy_free_check':True, 'exact_cuts': result.x}
-    else:
-        return {'envy_free_check':False, 'exact_cuts': None}
-    
-
-def find_division_four_agents(segments, agents, cuts):
+def segment_cumulative_areas(segments):
     '''
-    Runs the least squares solver to check if the investigated segments can contain
-    the necessary cuts for an envy-free division for four agents.
-    '''
-    cut_one_lower_bound = segments[0][cuts[0]]['start']
-    cut_one_upper_bound = segments[0][cuts[0]]['end']
-    cut_two_lower_bound = segments[0][cuts[1]]['start']
-    cut_two_upper_bound = segments[0][cuts[1]]['end']
-    cut_three_lower_bound = segments[0][cuts[2]]['start']
-    cut_three_upper_bound = segments[0][cuts[2]]['end']
-    
-    params = [cut_one_lower_bound, cut_two_lower_bound, cut_three_lower_bound, segments, agents, cuts]
-    cons = constraints_four_agents(segments, agents, cuts, params)
-    initial_guess = [cut_one_lower_bound, cut_two_lower_bound, cut_three_lower_bound]
-    cut_bounds = [(cut_one_lower_bound, cut_one_upper_bound), (cut_two_lower_bound, cut_two_upper_bound),
-                  (cut_three_lower_bound, cut_three_upper_bound)]
+    Returns the value of the cake up to each segment boundary for every agent, as a 
+    matrix by agent and boundary.
+    '''
+    return compile_segments(segments).cumulative_areas
 
-    def objective(vars, *args):
-        return 0
 
-    result = minimize(objective, initial_guess, args=(params,), constraints=cons, bounds= cut_bounds)
+def proportional_next_cuts(cumulative_areas, agents, cuts, tolerance):
+    '''
+    Returns the segments the next cut can fall in, given the segments of the cuts before
+    it, for the slice it ends to be worth at least a proportional share of the cake to
+    its agent. The last cut must also leave the last slice a proportional share.
+    '''
+    agents_number = len(agents)
+    slice_number = len(cuts)
+    areas = cumulative_areas[agents[slice_number]]
+    share = areas[-1] / agents_number - tolerance[agents[slice_number]]
+    #The least the cake before the slice can be worth with its start cut in its segment.
+    lowest_start_value = areas[cuts[-1]] if cuts else 0
+    next_cuts = np.arange(cuts[-1] if cuts else 0, len(areas) - 1)
+    next_cuts = next_cuts[areas[next_cuts + 1] - lowest_start_value >= share]
+    if slice_number == agents_number - 2:
+        last_areas = cumulative_areas[agents[-1]]
+        last_share = last_areas[-1] / agents_number - tolerance[agents[-1]]
+        next_cuts = next_cuts[last_areas[-1] - last_areas[next_cuts] >= last_share]
+    return next_cuts
 
-    if result.success:
-        return {'envy_free_check':True, 'exact_cuts': result.x}
-    else:
-        return {'envy_free_check':False, 'exact_cuts': None}
-    
 
-def find_division(segments, agents, cuts, agents_number):
+def envy_bounds_check(cumulative_areas, agents, cuts, tolerance):
     '''
-    Runs the solver for the correct number of agents.
+    Checks that the most each agent's slice can be worth to them is at least the least
+    any other slice can be worth to them, given the segments that hold the cuts.
     '''
-    if agents_number == 3:
-        return find_division_three_agents(segments, agents, cuts)
-    if agents_number == 4:
-        return find_division_four_agents(segments, agents, cuts)
-    
+    cuts = np.asarray(cuts)
+    for slice_number, agent in enumerate(agents):
+        areas = cumulative_areas[agent]
+        lowest_cut_values = np.concatenate([[0], areas[cuts], [areas[-1]]])
+        highest_cut_values = np.concatenate([[0], areas[cuts + 1], [areas[-1]]])
+        highest_slice_value = highest_cut_values[slice_number + 1] - \
+                              lowest_cut_values[slice_number]
+        lowest_slice_values = np.maximum(lowest_cut_values[1:] - highest_cut_values[:-1], 0)
+        if np.any(lowest_slice_values > highest_slice_value + tolerance[agent]):
+            return False
+    return True
 
-def solver(segments, agents_number):
+
+def midpoint_envy(cumulative_areas, agents, cuts):
     '''
-    Iterates over each agent and segment permutation until one is found that
-    can contain the cut positions for an envy-free division.
+    Returns the largest envy of any agent, relative to their value of the whole cake, 
+    with each cut placed at the midpoint of its segment.
     '''
-    amount_of_segments = len(segments[0])
-    cut_positions = []
-    assert (agents_number == 3) or (agents_number == 4),\
-        "Invalid agents number for algorithm"
-    if agents_number == 3:
-        for cut_one in range(amount_of_segments):
-            for cut_two in range(cut_one, amount_of_segments):
-                cut_positions.append([cut_one, cut_two])
-    if agents_number == 4:
-        for cut_one in range(amount_of_segments):
-            for cut_two in range(cut_one, amount_of_segments):
-                for cut_three in range(cut_two, amount_of_segments):
-                    cut_positions.append([cut_one, cut_two, cut_three])
+    cuts = np.asarray(cuts)
+    largest_envy = 0
+    for slice_number, agent in enumerate(agents):
+        areas = cumulative_areas[agent]
+        if areas[-1] == 0:
+            continue
+        cut_values = (areas[cuts] + areas[cuts + 1]) / 2
+        slice_values = np.diff(np.concatenate([[0], cut_values, [areas[-1]]]))
+        envy = (np.max(slice_values) - slice_values[slice_number]) / areas[-1]
+        largest_envy = max(largest_envy, envy)
+    return largest_envy
+
+
+def pruned_cut_segments(segments, agents_number):
+    '''
+    Lazily yields the agent permutation and cut segment combinations that pass the 
+    proportionality and envy bounds, in order of likely feasibility: by how many 
+    segments their cuts are from the cuts into equal shares of the agents' average 
+    valuation, and then by their envy with the cuts at the midpoints of their segments.
+    The combinations are searched best first, so those further out than the first 
+    feasible one are never visited.
+    '''
+    segments = compile_segments(segments)
+    cumulative_areas = segments.cumulative_areas
+    tolerance = 1e-9 * np.maximum(cumulative_areas[:, -1], 1)
+    equal_cuts, _, boundaries = equal_share_cuts(segments, agents_number)
+    guide = np.minimum(np.searchsorted(boundaries, equal_cuts, side = 'right') - 1, 
+                       len(boundaries) - 2)
+    #Each entry is a cut segment with the partial combination before it, ordered by the
+    #distance of both from the guide. The segments a cut can fall in are sorted by their
+    #distance, so each one is only pushed once the one before it is popped.
+    heap = []
+    order = itertools.count()
+
+    def push_next_cuts(distance, agents, cuts):
+        next_cuts = proportional_next_cuts(cumulative_areas, agents, cuts, tolerance)
+        if len(next_cuts) == 0:
+            return
+        offsets = np.abs(next_cuts - guide[len(cuts)])
+        by_offset = np.argsort(offsets, kind = 'stable')
+        options = (next_cuts[by_offset].tolist(), offsets[by_offset].tolist())
+        heapq.heappush(heap, (distance + options[1][0], next(order), distance, agents, 
+                              cuts, options, 0))
+
+    for agents in itertools.permutations(range(agents_number)):
+        push_next_cuts(0, agents, [])
+    while heap:
+        distance = heap[0][0]
+        candidates = []
+        with timed_phase('candidates'):
+            while heap and heap[0][0] == distance:
+                _, _, previous_distance, agents, cuts, options, index = heapq.heappop(heap)
+                if index + 1 < len(options[0]):
+                    heapq.heappush(heap, (previous_distance + options[1][index + 1], 
+                                          next(order), previous_distance, agents, cuts, 
+                                          options, index + 1))
+                cuts = cuts + [options[0][index]]
+                if len(cuts) < agents_number - 1:
+                    push_next_cuts(distance, agents, cuts)
+                elif envy_bounds_check(cumulative_areas, agents, cuts, tolerance) == True:
+                    candidates.append((midpoint_envy(cumulative_areas, agents, cuts), 
+                                       agents, cuts))
+            candidates.sort(key = lambda candidate: candidate[0])
+        for _, agents, cuts in candidates:
+            yield agents, cuts
+
+
+def exhaustive_cut_segments(amount_of_segments, agents_number):
+    '''
+    Yields every agent permutation and cut segment combination.
+    '''
+    cut_positions = [list(cuts) for cuts in 
+                     itertools.combinations_with_replacement(range(amount_of_segments), 
+                                                             agents_number - 1)]
     agents_list = [i for i in range(agents_number)]
     agents_permutations = list(itertools.permutations(agents_list))
     for agents in agents_permutations:
         for cuts in cut_positions:
-            info = find_division(segments, agents, cuts, agents_number)
-            if info['envy_free_check'] == True:
-                return cuts, info['exact_cuts'], agents
-            else:
-                continue
+            yield agents, cuts
+
+
+@timed('solver')
+def solver(segments, agents_number, method = 'linprog', search = 'pruned'):
+    '''
+    Iterates over each agent and segment permutation until one is found that
+    can contain the cut positions for an envy-free division. The pruned search skips
+    the combinations that cannot be envy-free and 'exhaustive' tries all of them. 
+    'milp' instead finds the permutation and segments in one mixed-integer program.
+    '''
+    segments = compile_segments(segments)
+    amount_of_segments = len(segments.starts)
+    assert agents_number >= 2, "Invalid agents number for algorithm"
+    if search == 'milp':
+        return find_division_mixed_integer_program(segments, agents_number)
+    if search == 'pruned':
+        candidates = pruned_cut_segments(segments, agents_number)
+    else:
+        candidates = exhaustive_cut_segments(amount_of_segments, agents_number)
+    for agents, cuts in candidates:
+        info = find_division(segments, agents, cuts, agents_number, method)
+        if info['envy_free_check'] == True:
+            return cuts, info['exact_cuts'], agents
+        else:
+            continue
     return False
 
-def piecewise_constant_algorithm(preferences, cake_size):
+def piecewise_constant_n_agents(preferences, cake_size, method = 'linprog', 
+                                search = 'milp'):
+    '''
+    Runs the piecewise-constant algorithm for any number of agents. The division is
+    returned as the list of cut positions and slice i + 1 goes to assignment[i + 1].
+    The mixed-integer program is used by default as the pruned search grows 
+    factorially with the number of agents. Raises NoDivisionFound if the solver fails.
     '''
-    Runs the piecewise-constant algorithm for finding an envy-free division.
+    agents_number = len(preferences)
+    raw_segments = find_segments(preferences, agents_number)
+    segments = scale_segments(raw_segments, cake_size)
+    division = solver(segments, agents_number, method, search)
+    if division == False:
+        raise NoDivisionFound(f'No envy-free division was found for {agents_number} agents.')
+    cut_positions, exact_cuts, agents = division
+    return {'segments': raw_segments,
+            'cut_positions': [int(cut) for cut in cut_positions],
+            'cuts': [float(cut * cake_size) for cut in exact_cuts],
+            'assignment': {slice_number + 1: agent 
+                           for slice_number, agent in enumerate(agents)},
+            'agents_number': agents_number}
+
+
+def piecewise_constant_algorithm(preferences, cake_size, method = 'linprog', 
+                                 search = 'pruned'):
+    '''
+    Runs the piecewise-constant algorithm for finding an envy-free division between
+    three or four agents. Raises PayloadError for any other number of agents and 
+    NoDivisionFound if the solver fails.
     '''
     agents_number = len(preferences)
+    if agents_number not in (3, 4):
+        raise PayloadError(f'The piecewise-constant algorithm divides the cake between 3 or '
+                           f'4 agents, not {agents_number}. Use piecewise_constant_n for '
+                           f'any other number.')
     raw_segments = find_segments(preferences, agents_number)
-    preferences = change_bounds(preferences, cake_size)
-    segments = find_segments(preferences, agents_number)
-    cut_positions, exact_cuts, agents = solver(segments, agents_number)
+    segments = scale_segments(raw_segments, cake_size)
+    division = solver(segments, agents_number, method, search)
+    if division == False:
+        raise NoDivisionFound(f'No envy-free division was found for {agents_number} agents.')
+    cut_positions, exact_cuts, agents = division
     if agents_number == 3:
         envy_free_division = ThreeAgentPortion(exact_cuts[0], exact_cuts[1])
         slice_assignments = {1: agents[0], 2: agents[1], 3: agents[2]}
@@ -2964,13 +3530,164 @@ def piecewise_constant_algorithm(preferences, cake_size):
         slice_assignments = {1: agents[0], 2: agents[1], 
                             3: agents[2], 4: agents[3]}
         raw_envy_free_division = raw_division(envy_free_division, cake_size, 4)
-    return jsonify({'segments': raw_segments,
-                    'cut_positions': cut_positions,
-                    'division': raw_envy_free_division,
-                    'assignment': slice_assignments,
-                    'agents_number': agents_number})
+    return {'segments': raw_segments,
+            'cut_positions': cut_positions,
+            'division': raw_envy_free_division,
+            'assignment': slice_assignments,
+            'agents_number': agents_number}
+
+
+#The algorithms by the name of their endpoint.
+ALGORITHMS = {'three_agent': branzei_nisan_additive,
+              'three_agent_monotone': branzei_nisan,
+              'four_agent': hollender_rubinstein,
+              'piecewise_constant': piecewise_constant_algorithm,
+              'piecewise_constant_n': piecewise_constant_n_agents}
+
+
+def result_cache_key(algorithm, preferences, cake_size, options = {}):
+    '''
+    Returns a hash of the algorithm, epsilon, cake size, the options that change the 
+    result and preferences normalized as by preprocess. Options left at the algorithm's
+    default are dropped, so passing them or not gives the same key.
+    '''
+    normalized_prefs = [np.column_stack(columns).tolist() for columns 
+                        in preprocess(preferences, cake_size).agents]
+    parameters = inspect.signature(ALGORITHMS[algorithm]).parameters
+    result_options = {name: options[name] for name in RESULT_OPTIONS 
+                      if name in options and options[name] != parameters[name].default}
+    canonical = json.dumps([algorithm, epsilon, cake_size, normalized_prefs, result_options], 
+                           separators = (',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def run_algorithm(algorithm, preferences, cake_size, session = None, **options):
+    '''
+    Runs an algorithm. If a solve session is given, its lock is held for the run so that
+    solves in the same session do not interleave.
+    '''
+    if session is None:
+        return ALGORITHMS[algorithm](preferences, cake_size, **options)
+    with session.lock:
+        return ALGORITHMS[algorithm](preferences, cake_size, session = session, **options)
+
+
+def cached_solve(algorithm, preferences, cake_size, refresh = False, **options):
+    '''
+    Runs an algorithm, returning the cached result if the same preferences have been 
+    solved recently unless refresh is set. Cached results are shared, so they should 
+    not be modified. Solves in a solve session skip the cache, as the session has to
+    see every solve to track which agents changed.
+    '''
+    cache = result_cache()
+    preferences = decode_preferences(preferences)
+    if options.get('session') is not None:
+        return run_algorithm(algorithm, preferences, cake_size, **options)
+    with timed_phase('result_cache'):
+        key = result_cache_key(algorithm, preferences, cake_size, options)
+        result = None if refresh == True else cache.get(key)
+    if result is None:
+        result = run_algorithm(algorithm, preferences, cake_size, **options)
+        cache.put(key, result)
+    return result
+
+
+def solve(algorithm, preferences, cake_size, timings = False, query_counts = False, 
+          **options):
+    '''
+    Runs cached_solve, adding the wall and CPU time of each phase and the number of 
+    queries made to a copy of the result as timings and query_counts if asked for.
+    Counting queries skips the cache lookup so that the algorithm is always run.
+    '''
+    if timings != True and query_counts != True:
+        return cached_solve(algorithm, preferences, cake_size, **options)
+    with record_timings() as phase_timings, record_query_counts() as counts:
+        result = cached_solve(algorithm, preferences, cake_size, 
+                              refresh = query_counts == True, **options)
+    result = dict(result)
+    if timings == True:
+        result['timings'] = phase_timings.as_dict()
+    if query_counts == True:
+        result['query_counts'] = counts.as_dict()
+    return result
+
+
+def solve_job(index, job):
+    '''
+    Runs the algorithm of a batch job on its preferences. Errors are returned with the
+    job rather than raised so that one bad job does not stop the rest of the batch.
+    '''
+    algorithm = None
+    try:
+        if not isinstance(job, dict):
+            return {'index': index, 'error': 'Each job must be an object.'}
+        algorithm = job.get('algorithm')
+        if algorithm not in ALGORITHMS:
+            return {'index': index, 'algorithm': algorithm, 
+                    'error': f'Unknown algorithm {algorithm}.'}
+        result = solve(algorithm, job.get('preferences'), job.get('cakeSize'), 
+                       job.get('timings'), job.get('query_counts'))
+    except Exception as error:
+        return {'index': index, 'algorithm': algorithm, 'error': repr(error)}
+    return {'index': index, 'algorithm': algorithm, 'result': result}
+
+
+def job_cache_key(job):
+    '''
+    Returns the result cache key of a batch or queued job, or None if its result is not
+    cached. Jobs asking for timings or query counts are always run, and malformed jobs 
+    are left to solve_job to report.
+    '''
+    if not isinstance(job, dict) or job.get('algorithm') not in ALGORITHMS:
+        return None
+    if job.get('timings') == True or job.get('query_counts') == True:
+        return None
+    try:
+        return result_cache_key(job['algorithm'], decode_preferences(job.get('preferences')),
+                                job.get('cakeSize'))
+    except Exception:
+        return None
+
+
+def job_lane(job):
+    '''
+    Returns the lane of the job queue a job runs in. Hollender-Rubinstein solves take 
+    seconds, as do piecewise-constant solves for more than four agents, while the 
+    others take milliseconds.
+    '''
+    if job['algorithm'] == 'four_agent':
+        return 'long'
+    if job['algorithm'] == 'piecewise_constant_n' and \
+        isinstance(job.get('preferences'), list) and len(job['preferences']) > 4:
+        return 'long'
+    return 'short'
+
+
+def request_session(data):
+    '''
+    Returns the solve session named by a request, starting a new one if it has expired,
+    or None if the request does not name one.
+    '''
+    session_id = data.get('session')
+    if session_id is None:
+        return None
+    return solve_sessions().get(str(session_id))
     
 
+def payload_error(error):
+    '''
+    Returns malformed preferences as a bad request.
+    '''
+    return jsonify({'error': str(error)}), 400
+
+
+def no_division_found(error):
+    '''
+    Returns a failure of the solver to find a division as an error for the request.
+    '''
+    return jsonify({'error': str(error)}), 422
+
+
 @app.route('/api/three_agent_monotone', methods=['POST'])
 def three_agent_additive():
     data = request.json
@@ -2981,7 +3698,10 @@ def three_agent_additive():
     # result = branzei_nisan(preferences, cake_size)
     # result_as_dict = [result.left, result.right]
     # return jsonify({'result': result_as_dict})
-    return branzei_nisan(preferences, cake_size)
+    return jsonify(solve('three_agent_monotone', preferences, cake_size, data.get('timings'), 
+                         data.get('query_counts'), 
+                         early_exit = data.get('early_exit') == True,
+                         session = request_session(data)))
 
 
 @app.route('/api/three_agent', methods=['POST'])
@@ -2994,7 +3714,9 @@ def three_agent():
     # result = branzei_nisan(preferences, cake_size)
     # result_as_dict = [result.left, result.right]
     # return jsonify({'result': result_as_dict})
-    return branzei_nisan_additive(preferences, cake_size)
+    return jsonify(solve('three_agent', preferences, cake_size, data.get('timings'), 
+                         data.get('query_counts'),
+                         session = request_session(data)))
 
 @app.route('/api/four_agent', methods=['POST'])
 def four_agent():
@@ -3009,7 +3731,10 @@ def four_agent():
     # division, assignment = hollender_rubinstein(preferences, cake_size)
     # return jsonify({'division': division,
     #                 'assignment': assignment})
-    return hollender_rubinstein(preferences, cake_size)
+    return jsonify(solve('four_agent', preferences, cake_size, data.get('timings'), 
+                         data.get('query_counts'), 
+                         early_exit = data.get('early_exit') == True,
+                         session = request_session(data), pool = invariant_pool()))
 
 
 @app.route('/api/piecewise_constant', methods=['POST'])
@@ -3025,7 +3750,293 @@ def piecewise_constant():
     # division, assignment = hollender_rubinstein(preferences, cake_size)
     # return jsonify({'division': division,
     #                 'assignment': assignment})
-    return piecewise_constant_algorithm(preferences, cake_size)
+    return jsonify(solve('piecewise_constant', preferences, cake_size, data.get('timings'), 
+                         data.get('query_counts')))
+
+
+@app.route('/api/piecewise_constant_n', methods=['POST'])
+def piecewise_constant_n():
+    '''
+    Divides the cake between any number of agents with piecewise-constant valuations.
+    '''
+    data = request.json
+    preferences = data.get('preferences')
+    cake_size = data.get('cakeSize')
+    return jsonify(solve('piecewise_constant_n', preferences, cake_size, 
+                         data.get('timings'), data.get('query_counts')))
+
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    '''
+    Solves a list of {algorithm, preferences, cakeSize} jobs on a process pool and 
+    streams back one JSON line per job, tagged with its index, as each one finishes.
+    '''
+    data = request.get_json(silent = True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'The body must be a JSON object.'}), 400
+    jobs = data.get('jobs')
+    if not isinstance(jobs, list):
+        return jsonify({'error': 'jobs must be a list.'}), 400
+    executor = batch_executor()
+    cache = result_cache()
+    cached_outputs = []
+    #The indices of the jobs each future solves and the future solving each cache key, 
+    #so that identical jobs in a batch are solved once.
+    futures = {}
+    key_futures = {}
+    for index, job in enumerate(jobs):
+        key = job_cache_key(job)
+        if key in key_futures:
+            futures[key_futures[key]].append(index)
+            continue
+        result = None if key is None else cache.get(key)
+        if result is not None:
+            cached_outputs.append({'index': index, 'algorithm': job['algorithm'], 
+                                   'result': result})
+            continue
+        future = executor.submit(solve_job, index, job)
+        futures[future] = [index]
+        if key is not None:
+            key_futures[key] = future
+    future_keys = {future: key for key, future in key_futures.items()}
+
+    def results():
+        for output in cached_outputs:
+            yield app.json.dumps(output) + '\n'
+        for future in as_completed(futures):
+            #A job that cannot be sent to or run by a worker fails alone rather than 
+            #ending the stream.
+            try:
+                output = future.result()
+            except Exception as error:
+                output = {'index': futures[future][0], 'error': repr(error)}
+            if 'result' in output and future in future_keys:
+                cache.put(future_keys[future], output['result'])
+            for index in futures[future]:
+                yield app.json.dumps(dict(output, index = index)) + '\n'
+
+    return Response(stream_with_context(results()), mimetype = 'application/x-ndjson')
+
+
+def stream_progress(algorithm, preferences, cake_size, **options):
+    '''
+    Runs an algorithm on a background thread and yields its progress events, then its 
+    result or error, as server-sent events. If the client goes away the generator is 
+    closed, and the algorithm is stopped at its next progress event.
+    '''
+    events = queue.Queue()
+    cancelled = threading.Event()
+    preferences = decode_preferences(preferences)
+
+    def progress(event):
+        if cancelled.is_set():
+            raise SolveCancelled()
+        events.put(event)
+
+    def run():
+        try:
+            with record_query_counts():
+                result = run_algorithm(algorithm, preferences, cake_size, 
+                                       progress = progress, **options)
+            events.put({'event': 'result', 'result': result})
+        except SolveCancelled:
+            return
+        except Exception as error:
+            events.put({'event': 'error', 'error': repr(error)})
+
+    threading.Thread(target = run, daemon = True).start()
+    try:
+        while True:
+            event = events.get()
+            yield f"event: {event['event']}\ndata: {app.json.dumps(event)}\n\n"
+            if event['event'] in ('result', 'error'):
+                return
+    finally:
+        cancelled.set()
+
+
+@app.route('/api/three_agent/stream', methods=['POST'])
+def three_agent_stream():
+    data = request.json
+    #Decoded before the stream starts so that a malformed payload is a bad request.
+    preferences = decode_preferences(data.get('preferences'))
+    cake_size = data.get('cakeSize')
+    events = stream_progress('three_agent', preferences, cake_size, 
+                             session = request_session(data))
+    return Response(stream_with_context(events), mimetype = 'text/event-stream')
+
+
+@app.route('/api/four_agent/stream', methods=['POST'])
+def four_agent_stream():
+    data = request.json
+    #Decoded before the stream starts so that a malformed payload is a bad request.
+    preferences = decode_preferences(data.get('preferences'))
+    cake_size = data.get('cakeSize')
+    events = stream_progress('four_agent', preferences, cake_size, 
+                             early_exit = data.get('early_exit') == True,
+                             session = request_session(data), pool = invariant_pool())
+    return Response(stream_with_context(events), mimetype = 'text/event-stream')
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    '''
+    Returns the hit rate and size of the result cache.
+    '''
+    return jsonify(result_cache().stats())
+
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    '''
+    Queues an {algorithm, preferences, cakeSize} job and returns its id straight away.
+    The result is fetched by polling /api/jobs/<id>.
+    '''
+    job = request.get_json(silent = True)
+    if not isinstance(job, dict):
+        return jsonify({'error': 'The body must be a JSON object.'}), 400
+    if job.get('algorithm') not in ALGORITHMS:
+        return jsonify({'error': f"Unknown algorithm {job.get('algorithm')}."}), 400
+    job_id = job_queue().submit(job)
+    if job_id is None:
+        return jsonify({'error': 'The job queue is full, try again later.'}), 503, \
+            {'Retry-After': '5'}
+    return jsonify({'id': job_id, 'status': 'queued'}), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    '''
+    Returns the status of a submitted job, with its result once it is done.
+    '''
+    status = job_queue().status(job_id)
+    if status is None:
+        return jsonify({'error': f'Unknown job {job_id}.'}), 404
+    return jsonify(status)
+
+
+@app.route('/api/sessions', methods=['POST'])
+def create_session():
+    '''
+    Starts a solve session. Passing its id as session with later solves reuses the 
+    compiled preferences and queries of the agents that have not changed.
+    '''
+    return jsonify({'id': solve_sessions().create()}), 201
+
+
+@app.route('/api/sessions/<session_id>', methods=['GET'])
+def session_stats(session_id):
+    '''
+    Returns which agents changed in the last solve of a session and its cache sizes.
+    '''
+    session = solve_sessions().get(session_id, create = False)
+    if session is None:
+        return jsonify({'error': f'Unknown session {session_id}.'}), 404
+    return jsonify(session.stats())
+
+
+@app.route('/api/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    '''
+    Ends a solve session and frees its caches.
+    '''
+    if solve_sessions().delete(session_id) == False:
+        return jsonify({'error': f'Unknown session {session_id}.'}), 404
+    return '', 204
+
+
+class PayloadError(ValueError):
+    '''
+    Raised when the preferences in a request are malformed, such as a columnar payload
+    that cannot be decoded.
+    '''
+
+
+class NoDivisionFound(Exception):
+    '''
+    Raised when the piecewise-constant solver finds no envy-free division.
+    '''
+
+
+class SolveCancelled(Exception):
+    '''
+    Raised from a progress callback to stop an algorithm whose client has gone away.
+    '''
+
+
+class InvariantPool:
+    '''
+    Worker processes for checking the invariant cases of Hollender-Rubinstein alpha 
+    steps in parallel. Each solve using them holds a slot in the ranks shared with the
+    workers, which stop checking a solve's cases once one with a lower rank holds.
+    '''
+    def __init__(self, max_workers, slots):
+        self.stop_ranks = multiprocessing.Array('i', slots)
+        self.free_slots = queue.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+        self.executor = ProcessPoolExecutor(max_workers = max_workers, 
+                                            initializer = init_invariant_worker,
+                                            initargs = (self.stop_ranks,))
+
+    def reserve(self, prefs):
+        '''
+        Returns a slot on the workers for solving the preferences, or None if every 
+        slot is taken.
+        '''
+        try:
+            slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            return None
+        state = pickle.dumps([(agent.breakpoints, agent.start_values, agent.end_values) 
+                              for agent in prefs.agents])
+        return InvariantWorkers(self, slot, uuid.uuid4().hex, state)
+
+
+class InvariantWorkers:
+    '''
+    A solve's slot on an invariant pool.
+    '''
+    def __init__(self, pool, slot, key, state):
+        self.pool = pool
+        self.slot = slot
+        self.key = key
+        self.state = state
+
+    def check(self, alpha, epsilon):
+        '''
+        Checks the invariant cases for alpha on the workers, one batch each, and returns
+        the result of the case that holds with the lowest rank.
+        '''
+        stop_ranks = self.pool.stop_ranks
+        stop_ranks[self.slot] = np.iinfo(np.int32).max
+        futures = [self.pool.executor.submit(check_invariant_case_batch, self.slot, 
+                                             self.key, self.state, alpha, epsilon, 
+                                             batch_number) 
+                   for batch_number in range(len(invariant_case_batches()))]
+        try:
+            found = [future.result() for future in futures]
+        finally:
+            #Stops any batch still running if one of them failed.
+            stop_ranks[self.slot] = -1
+        found = [batch_result for batch_result in found if batch_result is not None]
+        if len(found) == 0:
+            return InvariantResult(False)
+        return min(found, key = lambda batch_result: batch_result[0])[1]
+
+    def release(self):
+        self.pool.free_slots.put(self.slot)
+
+
+class InvariantResult:
+    '''
+    The outcome of an invariant check, with the division and info of the case that holds.
+    '''
+    def __init__(self, holds, division = None, info = None):
+        self.holds = holds
+        self.division = division
+        self.info = info
 
 
 class Bounds:
@@ -3037,6 +4048,47 @@ class Bounds:
         return (self.lower + self.upper) / 2
 
 
+class GridBounds:
+    '''
+    Bounds for a binary search over the epsilon grid. The bounds are held as integer
+    grid indices and the midpoint is always a grid point, so the search stops after
+    exactly ceil(log2(number of cells)) updates with the cell containing the cut.
+    The update functions set lower and upper to the midpoint, which maps back to
+    its grid index.
+    '''
+    def __init__(self, lower, upper, epsilon):
+        self.epsilon = epsilon
+        self.lower_index = grid_index(lower, epsilon)
+        self.upper_index = max(ceil(upper / epsilon - GRID_TOLERANCE), 
+                               self.lower_index + 1)
+
+    @property
+    def lower(self):
+        return self.lower_index * self.epsilon
+
+    @lower.setter
+    def lower(self, value):
+        self.lower_index = round(value / self.epsilon)
+
+    @property
+    def upper(self):
+        return self.upper_index * self.epsilon
+
+    @upper.setter
+    def upper(self, value):
+        self.upper_index = round(value / self.epsilon)
+
+    def midpoint(self):
+        return ((self.lower_index + self.upper_index) // 2) * self.epsilon
+
+    def converged(self):
+        return self.upper_index - self.lower_index <= 1
+
+    def epsilon_interval(self):
+        lower_bound_of_interval = self.lower_index * self.epsilon
+        return Bounds(lower_bound_of_interval, lower_bound_of_interval + self.epsilon)
+
+
 class ThreeAgentPortion:
     def __init__(self, left_cut, right_cut):
         self.left = left_cut
@@ -3049,6 +4101,545 @@ class FourAgentPortion:
         self.middle = middle_cut
         self.right = right_cut
 
+
+class AgentValuation:
+    '''
+    One agent's piecewise-linear valuation stored as arrays of breakpoints, slopes and
+    cumulative areas. The arrays are mirrored as lists because bisect on a list is
+    much cheaper than np.searchsorted for the single queries made by the algorithms.
+    '''
+    def __init__(self, breakpoints, start_values, end_values):
+        self.breakpoints = np.asarray(breakpoints, dtype=float)
+        self.start_values = np.asarray(start_values, dtype=float)
+        self.end_values = np.asarray(end_values, dtype=float)
+        widths = np.diff(self.breakpoints)
+        self.slopes = np.divide(self.end_values - self.start_values, widths,
+                                out=np.zeros_like(widths), where=widths > 0)
+        areas = 0.5 * (self.start_values + self.end_values) * widths
+        self.cumulative_areas = np.concatenate([[0.0], np.cumsum(areas)])
+        self._breakpoints = self.breakpoints.tolist()
+        self._start_values = self.start_values.tolist()
+        self._slopes = self.slopes.tolist()
+        self._cumulative_areas = self.cumulative_areas.tolist()
+        self._last_segment = len(self._start_values) - 1
+        self._hungry_breakpoints = {}
+
+    @classmethod
+    def from_segments(cls, segments):
+        '''
+        Builds the index from a list of segment dicts. Gaps between segments are
+        filled with zero valued segments.
+        '''
+        breakpoints = [0]
+        start_values = []
+        end_values = []
+        for segment in sorted(segments, key=lambda segment: segment['start']):
+            if segment['start'] > breakpoints[-1]:
+                breakpoints.append(segment['start'])
+                start_values.append(0)
+                end_values.append(0)
+            breakpoints.append(segment['end'])
+            start_values.append(segment['startValue'])
+            end_values.append(segment['endValue'])
+        return cls(breakpoints, start_values, end_values)
+
+    @classmethod
+    def from_columns(cls, starts, ends, start_values, end_values):
+        '''
+        Builds the index from arrays of segment starts, ends and values in the same way
+        as from_segments, without going through segment dicts.
+        '''
+        order = np.argsort(starts, kind = 'stable')
+        starts, ends = starts[order], ends[order]
+        start_values, end_values = start_values[order], end_values[order]
+        previous_ends = np.concatenate([[0.0], ends[:-1]])
+        gaps = starts > previous_ends
+        positions = np.arange(len(starts)) + np.cumsum(gaps)
+        breakpoints = np.zeros(len(starts) + int(gaps.sum()) + 1)
+        breakpoints[positions + 1] = ends
+        breakpoints[positions[gaps]] = starts[gaps]
+        all_start_values = np.zeros(len(breakpoints) - 1)
+        all_end_values = np.zeros(len(breakpoints) - 1)
+        all_start_values[positions] = start_values
+        all_end_values[positions] = end_values
+        return cls(breakpoints, all_start_values, all_end_values)
+
+    def cumulative_value(self, x):
+        '''
+        Returns the value of the interval from 0 to x.
+        '''
+        i = bisect_right(self._breakpoints, x) - 1
+        i = min(max(i, 0), self._last_segment)
+        width = x - self._breakpoints[i]
+        return self._cumulative_areas[i] + width * (self._start_values[i] + 
+                                                    0.5 * self._slopes[i] * width)
+
+    def cumulative_values(self, x):
+        '''
+        Vectorised version of cumulative_value for an array of positions.
+        '''
+        i = np.searchsorted(self.breakpoints, x, side='right') - 1
+        i = np.clip(i, 0, self._last_segment)
+        width = x - self.breakpoints[i]
+        return self.cumulative_areas[i] + width * (self.start_values[i] + 
+                                                   0.5 * self.slopes[i] * width)
+
+    def value(self, start, end):
+        '''
+        Returns the value of the interval from start to end.
+        '''
+        return self.cumulative_value(end) - self.cumulative_value(start)
+
+    def hungry_cumulative_value(self, x, epsilon):
+        '''
+        Returns value_query_hungry of the interval from 0 to x.
+        '''
+        return self.cumulative_value(x) / 2 + epsilon * x
+
+    def inverse_hungry_cumulative_value(self, target, epsilon):
+        '''
+        Returns the position at which hungry_cumulative_value reaches the target by
+        locating the segment and solving the quadratic on it.
+        '''
+        if epsilon not in self._hungry_breakpoints:
+            self._hungry_breakpoints[epsilon] = \
+                (self.cumulative_areas / 2 + epsilon * self.breakpoints).tolist()
+        hungry_breakpoints = self._hungry_breakpoints[epsilon]
+        if target <= hungry_breakpoints[0]:
+            return self._breakpoints[0]
+        if target >= hungry_breakpoints[-1]:
+            return self._breakpoints[-1]
+        i = min(bisect_right(hungry_breakpoints, target) - 1, self._last_segment)
+        remainder = target - hungry_breakpoints[i]
+        linear = self._start_values[i] / 2 + epsilon
+        quadratic = self._slopes[i] / 4
+        discriminant = max(linear**2 + 4 * quadratic * remainder, 0)
+        width = 2 * remainder / (linear + sqrt(discriminant))
+        return self._breakpoints[i] + width
+
+
+class CompiledPreferences:
+    '''
+    The compiled valuations of all agents, indexed by agent like the raw preferences.
+    Also holds the epsilon grid query cache, value grids and equipartitions for the run 
+    the preferences were compiled for, which may be shared with a solve session.
+    '''
+    def __init__(self, agents, grid_cache = None, additive_grids = None, 
+                 equipartitions = None):
+        self.agents = list(agents)
+        if grid_cache is None:
+            grid_cache = GridQueryCache()
+        self.grid_cache = grid_cache
+        self.additive_grids = {} if additive_grids is None else additive_grids
+        self.equipartitions = {} if equipartitions is None else equipartitions
+
+    def __getitem__(self, agent):
+        return self.agents[agent]
+
+    def __len__(self):
+        return len(self.agents)
+
+
+class ColumnarPreferences:
+    '''
+    Preferences held as read-only arrays of segment starts, ends, start values and end
+    values per agent. Every transformation returns new preferences, so they can be 
+    shared safely.
+    '''
+    def __init__(self, agents):
+        read_only_agents = []
+        for columns in agents:
+            read_only_columns = []
+            for column in columns:
+                column = np.asarray(column, dtype = float).view()
+                column.flags.writeable = False
+                read_only_columns.append(column)
+            read_only_agents.append(tuple(read_only_columns))
+        self.agents = tuple(read_only_agents)
+
+    @classmethod
+    def from_segments(cls, prefs):
+        agents = []
+        for agent_segments in prefs:
+            columns = np.array([[segment['start'], segment['end'], segment['startValue'], 
+                                 segment['endValue']] for segment in agent_segments], 
+                               dtype = float).reshape(-1, 4)
+            agents.append(tuple(columns.T))
+        return cls(agents)
+
+    def __len__(self):
+        return len(self.agents)
+
+    def scaled(self, cake_size, max_valuation):
+        return ColumnarPreferences([(starts / cake_size, ends / cake_size,
+                                     start_values / max_valuation, 
+                                     end_values / max_valuation)
+                                    for starts, ends, start_values, end_values 
+                                    in self.agents])
+
+    def hungry(self, epsilon):
+        agents = []
+        for starts, ends, start_values, end_values in self.agents:
+            if np.any((start_values == 0) & (end_values == 0)):
+                start_values = (1 - epsilon / 2) * start_values + epsilon / 2
+                end_values = (1 - epsilon / 2) * end_values + epsilon / 2
+            agents.append((starts, ends, start_values, end_values))
+        return ColumnarPreferences(agents)
+
+    def compile(self):
+        return CompiledPreferences([AgentValuation.from_columns(*columns) 
+                                    for columns in self.agents])
+
+
+class CompiledSegments:
+    '''
+    The segments of all agents as arrays. The agents share the segment bounds, so the 
+    starts and ends are held once and the values, areas and cumulative areas are 
+    matrices by agent and segment.
+    '''
+    def __init__(self, segments):
+        agents_number = len(segments)
+        self.starts = np.array([segment['start'] for segment in segments[0]], 
+                               dtype = float)
+        self.ends = np.array([segment['end'] for segment in segments[0]], dtype = float)
+        self.values = np.array([[segment['value'] for segment in agent_segments] 
+                                for agent_segments in segments], 
+                               dtype = float).reshape(agents_number, -1)
+        self.areas = np.array([[segment['area'] for segment in agent_segments] 
+                               for agent_segments in segments], 
+                              dtype = float).reshape(agents_number, -1)
+        self.cumulative_areas = np.concatenate([np.zeros((agents_number, 1)), 
+                                                np.cumsum(self.areas, axis = 1)], 
+                                               axis = 1)
+
+    def __len__(self):
+        return len(self.values)
+
+
+class PhaseTimings:
+    '''
+    Wall and CPU time and number of calls per phase, keyed on the path of nested phase
+    names. CPU time is that of the whole process.
+    '''
+    def __init__(self):
+        self.phases = {}
+        self.stack = []
+        self.wall_start = timer()
+        self.cpu_start = time.process_time()
+        self.total = None
+
+    def start(self, path):
+        self.phases.setdefault(path, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+        self.stack.append((path, timer(), time.process_time()))
+
+    def stop(self):
+        path, wall_start, cpu_start = self.stack.pop()
+        phase = self.phases[path]
+        phase['wall'] += timer() - wall_start
+        phase['cpu'] += time.process_time() - cpu_start
+        phase['calls'] += 1
+
+    def finish(self):
+        self.total = {'wall': timer() - self.wall_start, 
+                      'cpu': time.process_time() - self.cpu_start}
+
+    def as_dict(self):
+        return {'total': self.total,
+                'phases': {path: dict(phase) for path, phase in self.phases.items()}}
+
+
+class QueryCounts:
+    '''
+    Number of queries keyed on query type, agent and the phase they were made in.
+    '''
+    def __init__(self):
+        self.counts = {}
+        self.depth = 0
+
+    def add(self, query_type, agent, phase, number = 1):
+        key = (query_type, int(agent), phase)
+        self.counts[key] = self.counts.get(key, 0) + number
+
+    def as_dict(self):
+        by_type = {}
+        by_agent = {}
+        by_phase = {}
+        for (query_type, agent, phase), number in self.counts.items():
+            by_type[query_type] = by_type.get(query_type, 0) + number
+            by_agent[agent] = by_agent.get(agent, 0) + number
+            phase_counts = by_phase.setdefault(phase or 'other', {})
+            phase_counts[query_type] = phase_counts.get(query_type, 0) + number
+        return {'total': sum(by_type.values()),
+                'by_type': by_type,
+                'by_agent': by_agent,
+                'by_phase': by_phase}
+
+
+class GridQueryCache:
+    '''
+    Bounded LRU cache of epsilon grid queries keyed on (agent, start index, end index).
+    '''
+    def __init__(self, maxsize = 2**16):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+
+    def discard_agents(self, agents):
+        for key in [key for key in self.entries if key[0] in agents]:
+            del self.entries[key]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+
+class ResultCache:
+    '''
+    Bounded LRU cache of algorithm results keyed on a hash of the inputs. Entries older
+    than ttl seconds are treated as missing.
+    '''
+    def __init__(self, maxsize = 1024, ttl = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        if self.maxsize == 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups > 0 else 0
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate,
+                'size': len(self.entries), 'maxsize': self.maxsize, 'ttl': self.ttl}
+
+
+class JobLane:
+    '''
+    A process pool for one kind of job, with the jobs waiting for it. At most as many
+    jobs as there are workers are handed to the pool, so every job the pool holds is
+    running and the rest wait here.
+    '''
+    def __init__(self, max_workers):
+        self.executor = ProcessPoolExecutor(max_workers = max_workers, 
+                                            initializer = disable_result_cache)
+        self.max_workers = max_workers
+        self.waiting = deque()
+        self.running = 0
+
+
+class JobQueue:
+    '''
+    Runs submitted jobs and keeps their status and results for polling. Long and short
+    jobs run in separate lanes, so short jobs are not held up behind long ones. Each lane
+    holds at most max_queued waiting jobs, after which submit refuses jobs by returning 
+    None. Jobs whose result is in the result cache are done as soon as they are 
+    submitted, and results are added to it as jobs finish. Only the most recent 
+    max_jobs jobs are kept once they have finished.
+    '''
+    def __init__(self, lanes, max_queued = 100, max_jobs = 1000):
+        self.lanes = {name: JobLane(max_workers) for name, max_workers in lanes.items()}
+        self.max_queued = max_queued
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        #Reentrant as a done callback runs straight away if its job is already done.
+        self.lock = threading.RLock()
+
+    def submit(self, job):
+        lane_name = job_lane(job)
+        lane = self.lanes[lane_name]
+        job_id = uuid.uuid4().hex
+        key = job_cache_key(job)
+        result = None if key is None else result_cache().get(key)
+        with self.lock:
+            if result is not None:
+                self.jobs[job_id] = {'algorithm': job.get('algorithm'), 'lane': lane_name,
+                                     'future': None, 'output': {'result': result}}
+                self.evict()
+                return job_id
+            if len(lane.waiting) >= self.max_queued:
+                return None
+            self.jobs[job_id] = {'algorithm': job.get('algorithm'), 'lane': lane_name, 
+                                 'job': job, 'key': key, 'future': None}
+            lane.waiting.append(job_id)
+            self.dispatch(lane)
+            self.evict()
+        return job_id
+
+    def dispatch(self, lane):
+        while lane.running < lane.max_workers and len(lane.waiting) > 0:
+            job_id = lane.waiting.popleft()
+            record = self.jobs[job_id]
+            lane.running += 1
+            record['future'] = lane.executor.submit(solve_job, job_id, record.pop('job'))
+            record['future'].add_done_callback(partial(self.finished, lane, 
+                                                       record.pop('key')))
+
+    def finished(self, lane, key, future):
+        with self.lock:
+            lane.running -= 1
+            self.dispatch(lane)
+        if key is not None and future.cancelled() == False and \
+            future.exception() is None and 'result' in future.result():
+            result_cache().put(key, future.result()['result'])
+
+    def evict(self):
+        excess = len(self.jobs) - self.max_jobs
+        if excess <= 0:
+            return
+        finished = [job_id for job_id, record in self.jobs.items() 
+                    if 'output' in record or 
+                       (record['future'] is not None and record['future'].done())]
+        for job_id in finished[:excess]:
+            del self.jobs[job_id]
+
+    def status(self, job_id):
+        with self.lock:
+            record = self.jobs.get(job_id)
+            if record is None:
+                return None
+            future = record['future']
+            status = {'id': job_id, 'algorithm': record['algorithm'], 
+                      'lane': record['lane']}
+            output = record.get('output')
+            if output is None and future is None:
+                status['status'] = 'queued'
+                status['position'] = self.lanes[record['lane']].waiting.index(job_id)
+                return status
+        if output is None and future.done() == False:
+            status['status'] = 'running'
+            return status
+        if output is None:
+            try:
+                output = future.result()
+            except Exception as error:
+                output = {'error': repr(error)}
+        if 'error' in output:
+            status['status'] = 'failed'
+            status['error'] = output['error']
+        else:
+            status['status'] = 'done'
+            status['result'] = output['result']
+        return status
+
+
+class SolveSession:
+    '''
+    Compiled valuations and query caches kept between the solves of one editing session.
+    Each solve is diffed against the preferences of the previous one, and only the agents
+    whose preferences changed are recompiled and have their cached queries dropped.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fingerprints = []
+        self.agents = []
+        self.changed_agents = []
+        self.grid_cache = GridQueryCache()
+        self.additive_grids = {}
+        self.equipartitions = {}
+
+    def compile(self, prefs):
+        fingerprints = [hashlib.sha256(np.stack(columns).tobytes()).hexdigest() 
+                        for columns in prefs.agents]
+        changed_agents = [agent for agent in range(max(len(fingerprints), 
+                                                       len(self.fingerprints)))
+                          if fingerprints[agent:agent + 1] != 
+                             self.fingerprints[agent:agent + 1]]
+        self.agents = [AgentValuation.from_columns(*columns) if agent in changed_agents 
+                       else self.agents[agent] 
+                       for agent, columns in enumerate(prefs.agents)]
+        self.grid_cache.discard_agents(changed_agents)
+        for key in [key for key in self.additive_grids if key[0] in changed_agents]:
+            del self.additive_grids[key]
+        #The equipartition only depends on agent 0.
+        if 0 in changed_agents:
+            self.equipartitions.clear()
+        self.fingerprints = fingerprints
+        self.changed_agents = changed_agents
+        return CompiledPreferences(self.agents, self.grid_cache, self.additive_grids,
+                                   self.equipartitions)
+
+    def stats(self):
+        return {'agents': len(self.agents), 'changed_agents': self.changed_agents,
+                'grid_queries': self.grid_cache.stats(), 
+                'equipartitions': len(self.equipartitions)}
+
+
+class SessionStore:
+    '''
+    Bounded LRU store of solve sessions by id. Sessions unused for ttl seconds are 
+    replaced by new ones.
+    '''
+    def __init__(self, maxsize = 256, ttl = 1800):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self):
+        session_id = uuid.uuid4().hex
+        self.get(session_id)
+        return session_id
+
+    def get(self, session_id, create = True):
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if create == False:
+                    self.sessions.pop(session_id, None)
+                    return None
+                entry = (time.monotonic(), SolveSession())
+            self.sessions[session_id] = (time.monotonic(), entry[1])
+            self.sessions.move_to_end(session_id)
+            if len(self.sessions) > self.maxsize:
+                self.sessions.popitem(last = False)
+            return entry[1]
+
+    def delete(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+
+#Registered here rather than with decorators, since the exceptions are defined above.
+app.register_error_handler(PayloadError, payload_error)
+app.register_error_handler(NoDivisionFound, no_division_found)
+
         
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
@@ -1,127 +1,238 @@
-from base import hollender_rubinstein 
-from base import piecewise_constant_algorithm
+from base import branzei_nisan
 from base import branzei_nisan_additive
+from base import hollender_rubinstein
+from base import piecewise_constant_algorithm
+from base import piecewise_constant_n_agents
+from base import record_query_counts
 import numpy as np
 from timeit import default_timer as timer
+import argparse
 import csv
+import json
+import os
+import sys
 
-def runtime_three_agents():
-    for _ in range(20):
-        print('Hello')
-        agents_number = 3
-        cake_size = 5
-        prefs = [[] for _ in range(agents_number)]
-        values = np.random.uniform(low=0, high=10, size=(agents_number, cake_size))
-        for i in range(agents_number):
-            for j in range(cake_size):
-                prefs[i].append({'agent': i,
-                                'start': j,
-                                'end': j + 1,
-                                'startValue': values[i][j],
-                                'endValue': values[i][j]
-                })
-        with open('test_data.csv', 'w', newline='') as csvfile:
-            fieldnames = ['agent', 'start', 'end', 'startValue', 'endValue']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for i in range(agents_number):
-                writer.writerows(prefs[i])
-        start_time_branzei_nisan = timer()
-        branzei_nisan_additive(prefs, cake_size)
-        end_time_branzei_nisan = timer()
-        time_elapsed_branzei_nisan = end_time_branzei_nisan - \
-                                     start_time_branzei_nisan
-        print(f"Branzei Nisan with cake size {cake_size} takes {time_elapsed_branzei_nisan} seconds to run")
-
-        start_time_piecewise_constant = timer()
-        piecewise_constant_algorithm(prefs, cake_size)
-        end_time_piecewise_constant = timer()
-        time_elapsed_piecewise_constant = end_time_piecewise_constant - \
-                                          start_time_piecewise_constant
-        print(f"piecewise constant with cake size {cake_size} takes \
-            {time_elapsed_piecewise_constant} seconds to run")
-        
-        
-        data = [
-            {'algo': 'Hollender_Rubinstein', 'cake_size': cake_size, \
-                    'runtime': time_elapsed_branzei_nisan},
-            {'algo': 'Piecewise_constant', 'cake_size': cake_size, \
-                   'runtime': time_elapsed_piecewise_constant}
-        ]
-
-        #Uncomment the below to create the csv file
-
-        # with open('four_agent_runtime_tests.csv', 'w', newline='') as csvfile:
-        #     fieldnames = ['algo', 'cake_size', 'runtime']
-        #     writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        #     writer.writeheader()
-        #     writer.writerows(data)
-
-        with open('three_agent_runtime_tests.csv', 'a', newline='') as csvfile:
-            fieldnames = ['algo', 'cake_size', 'runtime']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writerows(data)
-
-def runtime_four_agents():
-    for _ in range(20):
-        print('Hello')
-        agents_number = 4
-        cake_size = 5
-        prefs = [[] for _ in range(agents_number)]
-        values = np.random.uniform(low=0, high=10, size=(agents_number, cake_size))
-        for i in range(agents_number):
-            for j in range(cake_size):
-                prefs[i].append({'agent': i,
-                                'start': j,
-                                'end': j + 1,
-                                'startValue': values[i][j],
-                                'endValue': values[i][j]
-                })
-        with open('test_data.csv', 'w', newline='') as csvfile:
-            fieldnames = ['agent', 'start', 'end', 'startValue', 'endValue']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for i in range(agents_number):
-                writer.writerows(prefs[i])
-        start_time_hollender_rubinstein = timer()
-        hollender_rubinstein(prefs, cake_size)
-        end_time_hollender_rubinstein = timer()
-        time_elapsed_hollender_rubinstein = end_time_hollender_rubinstein - \
-                                            start_time_hollender_rubinstein
-        print(f"Hollender-Rubinstein with cake size {cake_size} takes {time_elapsed_hollender_rubinstein} seconds to run")
-
-        start_time_piecewise_constant = timer()
-        piecewise_constant_algorithm(prefs, cake_size)
-        end_time_piecewise_constant = timer()
-        time_elapsed_piecewise_constant = end_time_piecewise_constant - \
-                                            start_time_piecewise_constant
-        print(f"piecewise constant with cake size {cake_size} takes \
-            {time_elapsed_piecewise_constant} seconds to run")
-        
-        
-        data = [
-            {'algo': 'eval', 'cake_size': cake_size, \
-                    'runtime': time_elapsed_hollender_rubinstein},
-            {'algo': 'Piecewise_constant', 'cake_size': cake_size, \
-                    'runtime': time_elapsed_piecewise_constant}
-            ]
-        
-        #Uncomment the below to create the csv file
-
-        # with open('four_agent_runtime_tests.csv', 'w', newline='') as csvfile:
-        #     fieldnames = ['algo', 'cake_size', 'runtime']
-        #     writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        #     writer.writeheader()
-        #     writer.writerows(data)
-
-        with open('four_agent_runtime_tests.csv', 'a', newline='') as csvfile:
-            fieldnames = ['algo', 'cake_size', 'runtime']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writerows(data)
-    
+#The algorithms that can be benchmarked, the numbers of agents they run for and the
+#valuation families they accept. The additive Branzei-Nisan algorithm does not terminate
+#when an agent values part of the cake at zero, so it is not run on sparse valuations.
+ALGORITHMS = {'branzei_nisan': (branzei_nisan_additive, (3,), ('constant', 'linear')),
+              'branzei_nisan_monotone': (branzei_nisan, (3,),
+                                         ('constant', 'linear', 'sparse')),
+              'hollender_rubinstein': (hollender_rubinstein, (4,),
+                                       ('constant', 'linear', 'sparse')),
+              'piecewise_constant': (piecewise_constant_algorithm, (3, 4),
+                                     ('constant', 'sparse')),
+              'piecewise_constant_n': (piecewise_constant_n_agents, tuple(range(2, 9)),
+                                       ('constant', 'sparse'))}
+#The algorithms whose alpha bisection can stop once the division is certified envy-free.
+EARLY_EXIT_ALGORITHMS = ('branzei_nisan_monotone', 'hollender_rubinstein')
+FAMILIES = ['constant', 'linear', 'sparse']
+MAX_VALUATION = 10
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test data')
+DEFAULT_BASELINE = os.path.join(TEST_DATA, 'benchmark_baseline.json')
+FIELDNAMES = ['algorithm', 'agents', 'segments', 'family', 'runs', 'median', 'p90',
+              'p95', 'min', 'max', 'mean', 'queries']
+
+
+def random_preferences(agents_number, segments_number, family, rng):
+    '''
+    Returns preferences on a cake of size segments_number made of unit width segments.
+    Constant valuations are piecewise-constant, linear ones are piecewise-linear and
+    sparse ones are piecewise-constant with about a third of the segments at zero.
+    '''
+    start_values = rng.uniform(low=0, high=MAX_VALUATION,
+                               size=(agents_number, segments_number))
+    if family == 'linear':
+        end_values = rng.uniform(low=0, high=MAX_VALUATION,
+                                 size=(agents_number, segments_number))
+    else:
+        end_values = start_values
+    if family == 'sparse':
+        zeros = rng.uniform(size=(agents_number, segments_number)) < 1 / 3
+        #Every agent keeps at least one valued segment.
+        zeros[np.arange(agents_number), rng.integers(segments_number,
+                                                     size=agents_number)] = False
+        start_values = np.where(zeros, 0, start_values)
+        end_values = start_values
+    prefs = [[] for _ in range(agents_number)]
+    for i in range(agents_number):
+        for j in range(segments_number):
+            prefs[i].append({'agent': i,
+                             'start': j,
+                             'end': j + 1,
+                             'startValue': float(start_values[i][j]),
+                             'endValue': float(end_values[i][j])})
+    return prefs
+
+
+def instance_seed(seed, agents_number, segments_number, family, run):
+    '''
+    Returns the seed of one instance, so that every algorithm sees the same instances
+    whatever the sweep.
+    '''
+    return [seed, agents_number, segments_number, FAMILIES.index(family), run]
+
+
+def time_algorithm(algorithm, prefs, cake_size, early_exit = False):
+    '''
+    Returns the wall time of one run of an algorithm and the number of queries it made.
+    '''
+    function = ALGORITHMS[algorithm][0]
+    options = {}
+    if early_exit == True and algorithm in EARLY_EXIT_ALGORITHMS:
+        options['early_exit'] = True
+    with record_query_counts() as counts:
+        start_time = timer()
+        function(prefs, cake_size, **options)
+        end_time = timer()
+    return end_time - start_time, counts.as_dict()['total']
+
+
+def summarise(algorithm, agents_number, segments_number, family, runtimes, queries):
+    '''
+    Returns the runtime percentiles of a configuration.
+    '''
+    runtimes = np.array(runtimes)
+    return {'algorithm': algorithm,
+            'agents': agents_number,
+            'segments': segments_number,
+            'family': family,
+            'runs': len(runtimes),
+            'median': float(np.median(runtimes)),
+            'p90': float(np.percentile(runtimes, 90)),
+            'p95': float(np.percentile(runtimes, 95)),
+            'min': float(runtimes.min()),
+            'max': float(runtimes.max()),
+            'mean': float(runtimes.mean()),
+            'queries': int(np.median(queries))}
+
+
+def run_benchmarks(algorithms, agents_numbers, segments_numbers, families, runs, seed,
+                   early_exit = False):
+    '''
+    Runs every supported combination of algorithm, number of agents, number of segments
+    and valuation family on the same seeded instances.
+    '''
+    results = []
+    for algorithm in algorithms:
+        _, supported_agents, supported_families = ALGORITHMS[algorithm]
+        for agents_number in agents_numbers:
+            if agents_number not in supported_agents:
+                continue
+            for segments_number in segments_numbers:
+                for family in families:
+                    if family not in supported_families:
+                        continue
+                    runtimes = []
+                    queries = []
+                    for run in range(runs):
+                        rng = np.random.default_rng(instance_seed(seed, agents_number,
+                                                                  segments_number,
+                                                                  family, run))
+                        prefs = random_preferences(agents_number, segments_number,
+                                                   family, rng)
+                        runtime, query_number = time_algorithm(algorithm, prefs,
+                                                               segments_number,
+                                                               early_exit)
+                        runtimes.append(runtime)
+                        queries.append(query_number)
+                    result = summarise(algorithm, agents_number, segments_number, family,
+                                       runtimes, queries)
+                    print(f"{algorithm} with {agents_number} agents, {segments_number} "
+                          f"{family} segments: median {result['median']:.4f}s, "
+                          f"p95 {result['p95']:.4f}s, {result['queries']} queries")
+                    results.append(result)
+    return results
 
-if __name__ == "__main__":
-    #Uncomment whichever tests you wish to run.
 
-    #runtime_three_agents()
-    runtime_four_agents()
+def write_json(results, path, settings):
+    with open(path, 'w') as jsonfile:
+        json.dump({'settings': settings, 'results': results}, jsonfile, indent=1)
+
+
+def write_csv(results, path):
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def result_key(result):
+    return (result['algorithm'], result['agents'], result['segments'], result['family'])
+
+
+def compare_to_baseline(results, baseline_path, threshold):
+    '''
+    Compares the median runtimes against the baseline and returns the configurations
+    that are slower than the baseline by more than the threshold ratio. Changes in the
+    number of queries are reported but do not fail the comparison.
+    '''
+    with open(baseline_path) as jsonfile:
+        baseline = {result_key(result): result for result in json.load(jsonfile)['results']}
+    regressions = []
+    for result in results:
+        baseline_result = baseline.get(result_key(result))
+        if baseline_result is None:
+            continue
+        ratio = result['median'] / baseline_result['median']
+        line = (f"{result['algorithm']} with {result['agents']} agents, "
+                f"{result['segments']} {result['family']} segments: "
+                f"{ratio:.2f}x baseline median")
+        if result['queries'] != baseline_result['queries']:
+            line += f", queries {baseline_result['queries']} -> {result['queries']}"
+        if ratio > threshold:
+            line += ' SLOWER'
+            regressions.append(result)
+        print(line)
+    return regressions
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Seeded runtime benchmarks of the '
+                                                 'division algorithms.')
+    parser.add_argument('--algorithms', nargs='+', choices=list(ALGORITHMS),
+                        default=list(ALGORITHMS))
+    parser.add_argument('--agents', nargs='+', type=int, default=[3, 4])
+    parser.add_argument('--segments', nargs='+', type=int, default=[5, 10])
+    parser.add_argument('--families', nargs='+', choices=FAMILIES, default=FAMILIES)
+    parser.add_argument('--runs', type=int, default=5,
+                        help='instances per configuration')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--early-exit', action='store_true',
+                        help='stop the alpha bisection once the division is envy-free')
+    parser.add_argument('--json', help='write the results to this JSON file')
+    parser.add_argument('--csv', help='write the results to this CSV file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline JSON file to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='overwrite the baseline with these results')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='largest allowed ratio of median runtime to the baseline')
+    return parser.parse_args(arguments)
+
+
+def main(arguments):
+    args = parse_arguments(arguments)
+    settings = {'algorithms': args.algorithms, 'agents': args.agents,
+                'segments': args.segments, 'families': args.families,
+                'runs': args.runs, 'seed': args.seed, 'early_exit': args.early_exit}
+    results = run_benchmarks(args.algorithms, args.agents, args.segments, args.families,
+                             args.runs, args.seed, args.early_exit)
+    if args.json:
+        write_json(results, args.json, settings)
+    if args.csv:
+        write_csv(results, args.csv)
+    if args.save_baseline:
+        write_json(results, args.baseline, settings)
+        return 0
+    if os.path.exists(args.baseline):
+        regressions = compare_to_baseline(results, args.baseline, args.threshold)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} configurations exceeded the slowdown threshold '
+                  f'of {args.threshold}.')
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))